@@ -23,6 +23,41 @@ inbound_source_path  = "dbfs:/FileStore/autoloader/landing/"
 inbound_source_schema_path  = "dbfs:/FileStore/autoloader/schema"
 bronze_mount_path   = "dbfs:/FileStore/autoloader/bronze/"
 checkpoint_path = "dbfs:/FileStore/autoloader/checkpoint/"
+schema_registry_path = "dbfs:/FileStore/autoloader/schema_registry/"   # Kept across runs so cold starts skip schema inference
+
+# COMMAND ----------
+
+# DBTITLE 1,Load Schema Registry Functions
+# MAGIC %run "./Schema_Registry"
+
+# COMMAND ----------
+
+# DBTITLE 1,Fan-Out Sink - Write One Micro-batch To Multiple Delta Tables From A Single Scan
+from concurrent.futures import ThreadPoolExecutor
+from pyspark import StorageLevel
+
+def fan_out_write(source_df, batch_id, app_id, targets, max_workers=4):
+  """Writes a micro-batch to several Delta tables while scanning the source only once.
+
+  targets maps each Delta path to the select expressions that project source_df for that table.
+  source_df is persisted unless the caller already cached it, and the targets are written
+  concurrently. Every write carries txnAppId/txnVersion so each target stays idempotent on retry.
+  """
+  owns_cache = not source_df.is_cached
+  if owns_cache:
+    source_df = source_df.persist(StorageLevel.MEMORY_AND_DISK)
+
+  def write_target(path, exprs):
+    source_df.selectExpr(*exprs).write.mode("append").format("delta").option("txnVersion", batch_id).option("txnAppId", app_id).save(path=path)
+
+  try:
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+      futures = [pool.submit(write_target, path, exprs) for path, exprs in targets.items()]
+      for future in futures:
+        future.result()          # Re-raise the first failed write so the batch is retried
+  finally:
+    if owns_cache:
+      source_df.unpersist()
 
 # COMMAND ----------
 
@@ -30,36 +65,146 @@ checkpoint_path = "dbfs:/FileStore/autoloader/checkpoint/"
 def parse_membership(bronze_df: DataFrame,batchId: str):
   app_id = "Test_Autoloader"
   
-  bronze_df = bronze_df.withColumn('Input_File_Name',input_file_name())
-  bronze_df = bronze_df.select("Id","membershipId","serviceMDEData.*","Input_File_Name")
-  
-  member=bronze_df.selectExpr("id as member_pk","membershipId as membership_id","FName as First_Name","LName as Last_Name","Input_File_Name")
-  member_address=bronze_df.selectExpr("id as member_pk","membershipId as membership_id","Address as Member_Address","Input_File_Name")
-                     
-  member.write.mode("append").format("delta").option("txnVersion", batchId).option("txnAppId", app_id).save(path=f"{bronze_mount_path}member")
-  member_address.write.mode("append").format("delta").option("txnVersion", batchId).option("txnAppId", app_id).save(path=f"{bronze_mount_path}member_address")
+  # _metadata.file_path replaces input_file_name(), which is not reliable once the batch is cached
+  member_keys = ["id as member_pk","membershipId as membership_id"]
+  input_file = ["_metadata.file_path as Input_File_Name"]
 
-  
+  fan_out_write(bronze_df, batchId, app_id, {
+    f"{bronze_mount_path}member": member_keys + ["serviceMDEData.FName as First_Name","serviceMDEData.LName as Last_Name"] + input_file,
+    f"{bronze_mount_path}member_address": member_keys + ["serviceMDEData.Address as Member_Address"] + input_file,
+  })
 
+  # Fields missing from the registered schema land in _rescued_data; register a new version so the next run reads them as columns
+  drifted_files = [r.file_path for r in bronze_df.where("_rescued_data IS NOT NULL").select("_metadata.file_path").distinct().collect()]
+  if drifted_files:
+    infer_and_register(schema_registry_path, "membership", drifted_files, "json")
+
+# COMMAND ----------
+
+# DBTITLE 1,Adaptive Admission Controller - Size Each Micro-batch From A Byte Budget And Observed Latency
+import time
+
+class AdmissionController:
+  """Chooses cloudFiles.maxBytesPerTrigger for the Autoloader stream.
+
+  The budget is halved when a micro-batch runs longer than target_latency_s and doubled when
+  batches finish in under half the target while the Autoloader backlog is deeper than the budget.
+  Rate limits are read when a stream starts, so a resize is applied by restarting the stream
+  from its checkpoint between micro-batches.
+  """
+  def __init__(self, initial_bytes=256 * 1024 * 1024, min_bytes=8 * 1024 * 1024,
+               max_bytes=8 * 1024 * 1024 * 1024, target_latency_s=60, backoff=0.5, growth=2.0):
+    self.min_bytes = min_bytes
+    self.max_bytes = max_bytes
+    self.target_latency_s = target_latency_s
+    self.backoff = backoff
+    self.growth = growth
+    self.budget_bytes = self._clamp(initial_bytes)
+    self.backlog_bytes = 0
+    self.resize_pending = False
+    self.batch_stats = []
+
+  def _clamp(self, value):
+    # pyspark.sql.functions.* shadows the min/max builtins in this notebook
+    if value < self.min_bytes:
+      return self.min_bytes
+    if value > self.max_bytes:
+      return self.max_bytes
+    return int(value)
+
+  def observe(self, batch_id, num_files, num_bytes, elapsed_s):
+    elapsed_s = elapsed_s if elapsed_s > 0 else 1e-3
+    self.batch_stats.append({
+      "batch_id": int(batch_id),
+      "budget_bytes": self.budget_bytes,
+      "num_files": int(num_files),
+      "num_bytes": int(num_bytes),
+      "elapsed_s": float(elapsed_s),
+      "files_per_sec": num_files / elapsed_s,
+      "bytes_per_sec": num_bytes / elapsed_s,
+    })
+    print(f"Batch {batch_id}: {num_files} files, {num_bytes} bytes in {elapsed_s:.1f}s "
+          f"({num_files / elapsed_s:.1f} files/s, {num_bytes / elapsed_s:.0f} bytes/s)")
+
+    if elapsed_s > self.target_latency_s:
+      new_budget = self._clamp(self.budget_bytes * self.backoff)        # Back off under pressure
+    elif elapsed_s < self.target_latency_s / 2 and self.backlog_bytes > self.budget_bytes:
+      new_budget = self._clamp(self.budget_bytes * self.growth)         # Grow while the backlog is deep
+    else:
+      new_budget = self.budget_bytes
+    if new_budget != self.budget_bytes:
+      print(f"Resizing micro-batch budget from {self.budget_bytes} to {new_budget} bytes")
+      self.budget_bytes = new_budget
+      self.resize_pending = True
+
+  def update_backlog(self, progress):
+    # Autoloader reports the files/bytes still waiting to be processed in its source metrics
+    if progress and progress["sources"]:
+      self.backlog_bytes = int(progress["sources"][0].get("metrics", {}).get("numBytesOutstanding", 0))
+
+
+def metered(batch_function, controller):
+  """Wraps a foreachBatch function so every micro-batch reports its files, bytes and latency."""
+  def run(batch_df, batch_id):
+    start = time.time()
+    batch_df = batch_df.persist(StorageLevel.MEMORY_AND_DISK)     # Decode the files once for metering and all writes
+    try:
+      admitted = batch_df.select("_metadata.file_path", "_metadata.file_size").distinct() \
+        .agg(count("*").alias("num_files"), sum("file_size").alias("num_bytes")).first()
+      batch_function(batch_df, batch_id)
+    finally:
+      batch_df.unpersist()
+    controller.observe(batch_id, admitted["num_files"], admitted["num_bytes"] or 0, time.time() - start)
+  return run
 
 # COMMAND ----------
 
 # DBTITLE 1,Autoloader Code - To read input stream and use foreachbatch to refer function
-df = spark.readStream.format('cloudFiles') \
-  .option('cloudFiles.format', 'json') \
-  .option('cloudFiles.schemaLocation',inbound_source_schema_path) \
-  .option("cloudFiles.schemaEvolutionMode", "rescue") \
-  .option("cloudFiles.inferColumnTypes", "true") \
-  .option("cloudFiles.useIncrementalListing","true") \
-  .option("maxFilesPerTrigger", 1) \
-  .load(inbound_source_path)
-
-df.writeStream \
-     .format("delta") \
-     .foreachBatch(parse_membership) \
-     .option("checkpointLocation",checkpoint_path) \
-     .trigger(once=True) \
-    .start()
+def start_autoloader(controller):
+  # Read with the registered schema; inference only runs the first time the dataset is seen
+  schema_version, membership_schema = resolve_schema(schema_registry_path, "membership")
+  if membership_schema is None:
+    schema_version, membership_schema = infer_and_register(schema_registry_path, "membership", inbound_source_path, "json")
+  print(f"Reading membership files with schema version {schema_version}")
+
+  df = spark.readStream.format('cloudFiles') \
+    .option('cloudFiles.format', 'json') \
+    .option('cloudFiles.schemaLocation',inbound_source_schema_path) \
+    .option("cloudFiles.schemaEvolutionMode", "rescue") \
+    .option("rescuedDataColumn", "_rescued_data") \
+    .schema(membership_schema) \
+    .option("cloudFiles.useIncrementalListing","true") \
+    .option("cloudFiles.maxBytesPerTrigger", controller.budget_bytes) \
+    .load(inbound_source_path) \
+    .select("*", "_metadata")
+
+  return df.writeStream \
+       .format("delta") \
+       .foreachBatch(metered(parse_membership, controller)) \
+       .option("checkpointLocation",checkpoint_path) \
+       .trigger(availableNow=True) \
+      .start()
+
+# Drain the backlog, restarting the stream from its checkpoint whenever the controller resizes the budget
+controller = AdmissionController()
+while True:
+  query = start_autoloader(controller)
+  while query.isActive and not controller.resize_pending:
+    query.awaitTermination(10)
+    controller.update_backlog(query.lastProgress)
+  if not query.isActive:
+    break
+  # The next availableNow batch has usually started by now; stop between two batches so none is aborted and recomputed
+  while query.isActive and query.status['isTriggerActive']:
+    time.sleep(0.1)
+  query.stop()
+  controller.resize_pending = False
+
+# COMMAND ----------
+
+# DBTITLE 1,Per-Batch Throughput (files/sec and bytes/sec)
+if controller.batch_stats:
+  display(spark.createDataFrame(controller.batch_stats))
 
 # COMMAND ----------
 
@@ -0,0 +1,81 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC 
+# MAGIC # Schema Registry
+# MAGIC 
+# MAGIC Small versioned registry of dataset schemas, stored as JSON files under a registry path (one folder per dataset, one file per version).
+# MAGIC 
+# MAGIC Readers resolve their schema by dataset name instead of inferring it on every cold start. Inference only runs when a dataset has no registered schema yet, or when new fields show up and a new version has to be registered.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run "./Schema_Registry"`
+
+# COMMAND ----------
+
+# DBTITLE 1,Resolve and Register Schema Versions
+import json
+from datetime import datetime
+from pyspark.sql.types import StructType, StructField
+
+def _dataset_path(registry_path, dataset):
+  return f"{registry_path.rstrip('/')}/{dataset}/"
+
+def _registered_versions(registry_path, dataset):
+  try:
+    files = dbutils.fs.ls(_dataset_path(registry_path, dataset))
+  except Exception as e:
+    if "FileNotFoundException" in str(e):
+      return []
+    raise
+  return sorted(int(f.name[1:-5]) for f in files if f.name.startswith("v") and f.name.endswith(".json"))
+
+def resolve_schema(registry_path, dataset):
+  """Returns (version, StructType) for the latest registered schema of a dataset, or (None, None)."""
+  versions = _registered_versions(registry_path, dataset)
+  if not versions:
+    return None, None
+  entry = json.loads(dbutils.fs.head(f"{_dataset_path(registry_path, dataset)}v{versions[-1]:05d}.json", 10 * 1024 * 1024))
+  return entry["version"], StructType.fromJson(entry["schema"])
+
+def register_schema(registry_path, dataset, schema):
+  """Stores schema as the next version of dataset, unless it matches the latest version. Returns (version, schema)."""
+  version, latest = resolve_schema(registry_path, dataset)
+  if latest is not None and latest.jsonValue() == schema.jsonValue():
+    return version, latest
+  version = (version or 0) + 1
+  entry = {"version": version, "registered_at": datetime.utcnow().isoformat(), "schema": schema.jsonValue()}
+  dbutils.fs.put(f"{_dataset_path(registry_path, dataset)}v{version:05d}.json", json.dumps(entry))
+  print(f"Registered schema version {version} for dataset {dataset}")
+  return version, schema
+
+def merge_schemas(base, other):
+  """Adds the fields of other that are missing from base, recursing into nested structs."""
+  fields = {f.name.lower(): f for f in base.fields}
+  merged = []
+  for field in base.fields:
+    match = next((o for o in other.fields if o.name.lower() == field.name.lower()), None)
+    if match is not None and isinstance(field.dataType, StructType) and isinstance(match.dataType, StructType):
+      field = StructField(field.name, merge_schemas(field.dataType, match.dataType), field.nullable, field.metadata)
+    merged.append(field)
+  merged += [o for o in other.fields if o.name.lower() not in fields]
+  return StructType(merged)
+
+def infer_and_register(registry_path, dataset, paths, file_format="json"):
+  """Infers the schema of paths and registers it, merged with the current version if there is one."""
+  inferred = spark.read.format(file_format).option("inferSchema", "true").load(paths).schema
+  version, current = resolve_schema(registry_path, dataset)
+  return register_schema(registry_path, dataset, inferred if current is None else merge_schemas(current, inferred))
+
+def load_with_registry(registry_path, dataset, path, file_format="json", refresh=False):
+  """Batch-reads path with the registered schema of dataset, inferring it only on first use or when refresh=True.
+  Values that do not fit the schema (e.g. new fields) are kept in the _rescued_data column; pass the rows of the caller's
+  own action to register_rescued_fields, so drift is detected without scanning the files again."""
+  version, schema = resolve_schema(registry_path, dataset)
+  if schema is None or refresh:
+    version, schema = infer_and_register(registry_path, dataset, path, file_format)
+  return spark.read.format(file_format).schema(schema).option("rescuedDataColumn", "_rescued_data").load(path)
+
+def register_rescued_fields(registry_path, dataset, rows, path, file_format="json"):
+  """Registers a new schema version, inferred from path, when any of the rows already read by the caller has _rescued_data."""
+  if any(row["_rescued_data"] is not None for row in rows):
+    return infer_and_register(registry_path, dataset, path, file_format)
+  return resolve_schema(registry_path, dataset)
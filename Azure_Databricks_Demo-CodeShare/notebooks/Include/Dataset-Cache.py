@@ -0,0 +1,86 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC 
+# MAGIC # Dataset Cache
+# MAGIC 
+# MAGIC Content-addressed local cache for remote training inputs (e.g. CSV files downloaded over HTTP). Every file is stored under the SHA-256 of its content, and a small index maps each URL to the checksum it was last downloaded with.
+# MAGIC 
+# MAGIC Cached files are validated against their checksum before use, so a truncated or corrupted copy is downloaded again instead of being read. Once a URL is cached, it can be read without any network access, which also allows notebooks to run in air-gapped workspaces (copy the cache folder over, or pass the expected `sha256`).
+# MAGIC 
+# MAGIC CSV files can optionally be converted to Parquet on first read, so repeated reads load a columnar file instead of re-parsing the CSV.
+# MAGIC 
+# MAGIC Use it from another notebook with `%run "../Include/Dataset-Cache"`
+
+# COMMAND ----------
+
+# DBTITLE 1,Cache and Read Remote Datasets
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import urllib.request
+import pandas as pd
+
+DATASET_CACHE_PATH = "/dbfs/FileStore/dataset_cache/"
+
+def _file_sha256(path):
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(1024 * 1024), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+def _index_path(cache_path, url):
+  return os.path.join(cache_path, "urls", hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+def _object_path(cache_path, sha256, extension):
+  return os.path.join(cache_path, "objects", sha256 + extension)
+
+def _valid_object(path, sha256):
+  return os.path.exists(path) and _file_sha256(path) == sha256
+
+def cached_download(url, sha256=None, cache_path=DATASET_CACHE_PATH):
+  """Returns the local path of the cached content of url, downloading it only when it is not cached or fails validation.
+  When sha256 is given, the content must match it; otherwise it must match the checksum recorded at first download."""
+  extension = os.path.splitext(url.split("?")[0])[1]
+  index_path = _index_path(cache_path, url)
+  if sha256 is None and os.path.exists(index_path):
+    with open(index_path) as f:
+      sha256 = json.load(f)["sha256"]
+  if sha256 is not None and _valid_object(_object_path(cache_path, sha256, extension), sha256):
+    return _object_path(cache_path, sha256, extension)
+
+  # Download to a temporary file first, so a failed download never leaves a partial object in the cache
+  os.makedirs(os.path.join(cache_path, "objects"), exist_ok=True)
+  os.makedirs(os.path.dirname(index_path), exist_ok=True)
+  with tempfile.NamedTemporaryFile(delete=False, suffix=extension) as tmp:
+    with urllib.request.urlopen(url) as response:
+      shutil.copyfileobj(response, tmp)
+  downloaded = _file_sha256(tmp.name)
+  if sha256 is not None and downloaded != sha256:
+    os.remove(tmp.name)
+    raise ValueError(f"Checksum mismatch for {url}: expected {sha256}, downloaded {downloaded}")
+
+  object_path = _object_path(cache_path, downloaded, extension)
+  shutil.move(tmp.name, object_path)
+  with open(index_path, "w") as f:
+    json.dump({"url": url, "sha256": downloaded}, f)
+  print(f"Cached {url} as {object_path}")
+  return object_path
+
+def read_cached_csv(url, sha256=None, parquet=True, cache_path=DATASET_CACHE_PATH, **read_csv_options):
+  """Reads a remote CSV file into pandas through the cache. With parquet=True, the parsed CSV is also stored as Parquet
+  (next to the CSV and keyed by its checksum and read options) and read from there on later calls."""
+  csv_path = cached_download(url, sha256, cache_path)
+  if not parquet:
+    return pd.read_csv(csv_path, **read_csv_options)
+
+  options_key = hashlib.sha256(json.dumps(read_csv_options, sort_keys=True, default=str).encode()).hexdigest()[:12]
+  parquet_path = f"{os.path.splitext(csv_path)[0]}.{options_key}.parquet"
+  if os.path.exists(parquet_path):
+    return pd.read_parquet(parquet_path)
+  data = pd.read_csv(csv_path, **read_csv_options)
+  data.to_parquet(parquet_path + ".tmp", index=False)
+  os.replace(parquet_path + ".tmp", parquet_path)
+  return data
@@ -8,6 +8,18 @@
 
 # COMMAND ----------
 
+# MAGIC %md JSON reads below resolve their schema from a versioned schema registry instead of inferring it on every run. Values that do not fit the registered schema land in the `_rescued_data` column. `register_rescued_fields` checks the rows each cell already read and, when new fields show up, infers and registers a new schema version that the next read uses, without scanning the files again. Pass `refresh=True` to `load_with_registry` to force re-inference.
+
+# COMMAND ----------
+
+# MAGIC %run "../Include/Schema-Registry"
+
+# COMMAND ----------
+
+schema_registry_path = "dbfs:/FileStore/schema_registry/"
+
+# COMMAND ----------
+
 # MAGIC %md ## Azure Blob Storage
 
 # COMMAND ----------
@@ -36,8 +48,10 @@ spark.conf.set(
   storage_account_access_key)
 
 filename = 'simple-GSETHI-A-2.f6.json'
-df = spark.read.format(file_type).option("inferSchema", "true").load(file_location + filename)
-df.head(5)
+df = load_with_registry(schema_registry_path, "simple-GSETHI-A-2", file_location + filename, file_type)
+rows = df.head(5)
+register_rescued_fields(schema_registry_path, "simple-GSETHI-A-2", rows, file_location + filename, file_type)
+rows
 
 # COMMAND ----------
 
@@ -59,8 +73,10 @@ spark.conf.set(
   dbutils.secrets.get(scope = akv_secret_scope, key = akv_secret_key))
 
 filename = 'simple-GSETHI-A-2.f6.json'
-df = spark.read.format(file_type).option("inferSchema", "true").load(file_location + filename)
-df.head(5)
+df = load_with_registry(schema_registry_path, "simple-GSETHI-A-2", file_location + filename, file_type)
+rows = df.head(5)
+register_rescued_fields(schema_registry_path, "simple-GSETHI-A-2", rows, file_location + filename, file_type)
+rows
 
 # COMMAND ----------
 
@@ -87,8 +103,10 @@ spark.conf.set(
   sas_blob)
 
 filename = 'simple-GSETHI-A-2.f6.json'
-df = spark.read.format(file_type).option("inferSchema", "true").load(file_location + filename)
-df.head(5)
+df = load_with_registry(schema_registry_path, "simple-GSETHI-A-2", file_location + filename, file_type)
+rows = df.head(5)
+register_rescued_fields(schema_registry_path, "simple-GSETHI-A-2", rows, file_location + filename, file_type)
+rows
 
 # COMMAND ----------
 
@@ -19,6 +19,7 @@ import mlflow
 import mlflow.tracking
 import mlflow.entities
 import mlflow.azureml
+import mlflow.sklearn
 from mlflow.tracking import MlflowClient
 
 # Get the required classes from the AzureML libraries
@@ -27,6 +28,14 @@ from azureml.core.webservice import AciWebservice, Webservice
 
 # COMMAND ----------
 
+# MAGIC %md The wine-quality CSV is read through a local dataset cache: it is only downloaded on first use (or when the cached copy fails its checksum), and later runs read a Parquet copy from DBFS, without network access.
+
+# COMMAND ----------
+
+# MAGIC %run "../Include/Dataset-Cache"
+
+# COMMAND ----------
+
 # Setup code
 import os
 import warnings
@@ -42,7 +51,7 @@ location = "Australia Southeast"
 csv_url =\
     'http://archive.ics.uci.edu/ml/machine-learning-databases/wine-quality/winequality-red.csv'
 try:
-    data = pd.read_csv(csv_url, sep=';')
+    data = read_cached_csv(csv_url, sep=';')
 except Exception as e:
         print(
             "Unable to download training & test CSV, check your internet connection. Error: %s", e)
@@ -75,52 +84,42 @@ display(data)
 
 # COMMAND ----------
 
-# Wine quality (0-10) based on various physicochemical tests
-def train(in_alpha, in_l1_ratio):
-    import os
-    import warnings
-    import sys
+# Split the wine-quality data once (0.75, 0.25 split); every training run and sweep reuses the same split
+from sklearn.model_selection import train_test_split
 
-    import pandas as pd
+np.random.seed(40)
+train_data, test_data = train_test_split(data)
+
+# The predicted column is "quality" which is a scalar from [3, 9]
+wine_split = (train_data.drop(["quality"], axis=1), test_data.drop(["quality"], axis=1), train_data[["quality"]], test_data[["quality"]])
+
+# Fit and evaluate one ElasticNet model - no MLflow calls, so it can also run on the executors
+def fit_elasticnet(alpha, l1_ratio, split):
+    import warnings
     import numpy as np
     from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
-    from sklearn.model_selection import train_test_split
     from sklearn.linear_model import ElasticNet
 
-    import mlflow
-    import mlflow.sklearn
-    
-    import logging
-    logging.basicConfig(level=logging.WARN)
-    logger = logging.getLogger(__name__)
-
-    def eval_metrics(actual, pred):
-        rmse = np.sqrt(mean_squared_error(actual, pred))
-        mae = mean_absolute_error(actual, pred)
-        r2 = r2_score(actual, pred)
-        return rmse, mae, r2
-
-
     warnings.filterwarnings("ignore")
-    np.random.seed(40)
+    train_x, test_x, train_y, test_y = split
 
-    # Read the wine-quality csv file from the URL
-    csv_url =\
-        'http://archive.ics.uci.edu/ml/machine-learning-databases/wine-quality/winequality-red.csv'
-    try:
-        data = pd.read_csv(csv_url, sep=';')
-    except Exception as e:
-        logger.exception(
-            "Unable to download training & test CSV, check your internet connection. Error: %s", e)
+    # Execute ElasticNet
+    lr = ElasticNet(alpha=alpha, l1_ratio=l1_ratio, random_state=42)
+    lr.fit(train_x, train_y)
 
-    # Split the data into training and test sets. (0.75, 0.25) split.
-    train, test = train_test_split(data)
+    # Evaluate Metrics
+    predicted_qualities = lr.predict(test_x)
+    metrics = {
+        "rmse": float(np.sqrt(mean_squared_error(test_y, predicted_qualities))),
+        "mae": float(mean_absolute_error(test_y, predicted_qualities)),
+        "r2": float(r2_score(test_y, predicted_qualities))
+    }
+    return lr, metrics
 
-    # The predicted column is "quality" which is a scalar from [3, 9]
-    train_x = train.drop(["quality"], axis=1)
-    test_x = test.drop(["quality"], axis=1)
-    train_y = train[["quality"]]
-    test_y = test[["quality"]]
+# Wine quality (0-10) based on various physicochemical tests
+def train(in_alpha, in_l1_ratio):
+    import mlflow
+    import mlflow.sklearn
 
     # Set default values if no alpha is provided
     if float(in_alpha) is None:
@@ -136,26 +135,20 @@ def train(in_alpha, in_l1_ratio):
 
     # Useful for multiple runs (only doing one run in this sample notebook)    
     with mlflow.start_run():
-        # Execute ElasticNet
-        lr = ElasticNet(alpha=alpha, l1_ratio=l1_ratio, random_state=42)
-        lr.fit(train_x, train_y)
-
-        # Evaluate Metrics
-        predicted_qualities = lr.predict(test_x)
-        (rmse, mae, r2) = eval_metrics(test_y, predicted_qualities)
+        lr, metrics = fit_elasticnet(alpha, l1_ratio, wine_split)
 
         # Print out metrics
         print("Elasticnet model (alpha=%f, l1_ratio=%f):" % (alpha, l1_ratio))
-        print("  RMSE: %s" % rmse)
-        print("  MAE: %s" % mae)
-        print("  R2: %s" % r2)
+        print("  RMSE: %s" % metrics["rmse"])
+        print("  MAE: %s" % metrics["mae"])
+        print("  R2: %s" % metrics["r2"])
 
         # Log parameter, metrics, and model to MLflow
         mlflow.log_param("alpha", alpha)
         mlflow.log_param("l1_ratio", l1_ratio)
-        mlflow.log_metric("rmse", rmse)
-        mlflow.log_metric("r2", r2)
-        mlflow.log_metric("mae", mae)
+        mlflow.log_metric("rmse", metrics["rmse"])
+        mlflow.log_metric("r2", metrics["r2"])
+        mlflow.log_metric("mae", metrics["mae"])
 
         mlflow.sklearn.log_model(lr, "model")
 
@@ -170,17 +163,59 @@ train(0.5, 0.5)
 
 # COMMAND ----------
 
-# Test a few more times with different alpha/l1_ratio combinations
-train(0.5, 0.4)
-train(0.5, 0.6)
-train(0.6, 0.3)
-train(0.6, 0.4)
-train(0.6, 0.5)
-train(0.6, 0.6)
-train(0.7, 0.3)
-train(0.7, 0.4)
-train(0.7, 0.5)
-train(0.7, 0.6)
+# Champion index: the "champion" alias of the WineQuality registered model always points at the version with the lowest RMSE
+# (registered model aliases need MLflow 2.3+). It is updated at training time, and resolving it is a single registry lookup
+model_name = 'WineQuality'
+CHAMPION_ALIAS = 'champion'
+
+def champion_version():
+    try:
+        return client.get_model_version_by_alias(model_name, CHAMPION_ALIAS)
+    except mlflow.exceptions.MlflowException:
+        return None
+
+# Register the model of a run and point the champion alias at it, unless the current champion has a lower RMSE
+def promote_champion(run_id, rmse):
+    champion = champion_version()
+    if champion is not None and client.get_run(champion.run_id).data.metrics.get("rmse", float("inf")) <= rmse:
+        return champion
+    if not client.search_registered_models(filter_string=f"name = '{model_name}'"):
+        client.create_registered_model(model_name)
+    version = client.create_model_version(model_name, client.get_run(run_id).info.artifact_uri + '/model', run_id)
+    client.set_registered_model_alias(model_name, CHAMPION_ALIAS, version.version)
+    print("Model version %s of %s is the new %s (rmse=%f)" % (version.version, model_name, CHAMPION_ALIAS, rmse))
+    return version
+
+# Sweep a grid of alpha/l1_ratio combinations in parallel: the split is broadcast once, every combination is fitted in its own
+# Spark task, and the results are logged to MLflow on the driver as child runs of a single sweep run (one log_batch call per run).
+# Only the best model is logged as an artifact, and it is promoted to champion if it beats the current one.
+def sweep(param_grid):
+    split = spark.sparkContext.broadcast(wine_split)
+    results = spark.sparkContext.parallelize(param_grid, len(param_grid)) \
+        .map(lambda params: (params, *fit_elasticnet(params[0], params[1], split.value))) \
+        .collect()
+    split.unpersist()
+
+    best_params = min(results, key=lambda result: result[2]["rmse"])[0]
+    timestamp = int(time.time() * 1000)
+    with mlflow.start_run(run_name="elasticnet_sweep") as sweep_run:
+        for (alpha, l1_ratio), lr, metrics in results:
+            run = client.create_run(sweep_run.info.experiment_id, tags={"mlflow.parentRunId": sweep_run.info.run_id})
+            client.log_batch(run.info.run_id,
+                             metrics=[mlflow.entities.Metric(key, value, timestamp, 0) for key, value in metrics.items()],
+                             params=[mlflow.entities.Param("alpha", str(alpha)), mlflow.entities.Param("l1_ratio", str(l1_ratio))])
+            if (alpha, l1_ratio) == best_params:
+                with mlflow.start_run(run_id=run.info.run_id, nested=True):
+                    mlflow.sklearn.log_model(lr, "model")
+                best_run_id, best_rmse = run.info.run_id, metrics["rmse"]
+            client.set_terminated(run.info.run_id)
+    print("Best of %d combinations: alpha=%s, l1_ratio=%s" % (len(results), best_params[0], best_params[1]))
+    promote_champion(best_run_id, best_rmse)
+    return results
+
+client = MlflowClient()
+param_grid = [(alpha, l1_ratio) for alpha in np.arange(0.1, 1.01, 0.1).round(2) for l1_ratio in np.arange(0.05, 1.0, 0.05).round(2)]
+sweep_results = sweep(param_grid)
 
 # COMMAND ----------
 
@@ -204,25 +239,22 @@ dfRuns
 
 # COMMAND ----------
 
-dfRuns.iloc[0]
+# The best model is resolved through the champion alias instead of searching and sorting the experiment's runs
+mdlWineVersion = champion_version()
+if mdlWineVersion is None:
+    raise ValueError(f"{model_name} has no '{CHAMPION_ALIAS}' version yet, run the sweep above first")
+mdlWineVersion
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC ### Below we will register the model as Version 1 - this can also be done via the GUI
+# MAGIC ### The sweep registered the best model as a version of `WineQuality` and pointed the `champion` alias at it - this can also be done via the GUI
 
 # COMMAND ----------
 
-# We can register the model from the MLflow UI or via the API
-client = MlflowClient()
-
-model_name = 'WineQuality'
-model_source = dfRuns.iloc[0].artifact_uri + '/model'
-model_run_id = dfRuns.iloc[0].run_id
-
-mdlWine = client.create_registered_model(model_name)
-mdlWineVersion = client.create_model_version(model_name, model_source, model_run_id)
-time.sleep(5)
+# The champion version was registered from the MLflow API at training time; its source is the model artifact of the best run
+model_source = mdlWineVersion.source
+model_run_id = mdlWineVersion.run_id
 
 # COMMAND ----------
 
@@ -239,7 +271,7 @@ client.list_registered_models()
 
 # Transition model to staging
 
-client.transition_model_version_stage(name=model_name, version=1, stage='Staging')
+client.transition_model_version_stage(name=model_name, version=mdlWineVersion.version, stage='Staging')
 
 # COMMAND ----------
 
@@ -331,7 +363,7 @@ service_query(sample_json)
 # Cleanup
 
 Webservice.list(workspace=azure_workspace)[0].delete()
-client.transition_model_version_stage(name=model_name, version=1, stage='Archived')
+client.transition_model_version_stage(name=model_name, version=mdlWineVersion.version, stage='Archived')
 client.delete_registered_model(model_name)
 
 # COMMAND ----------
@@ -17,6 +17,7 @@
 # AzureML Workspace info (name, region, resource group and subscription ID) for model deployment
 dbutils.widgets.text("Storage Account","<your ADLS Gen 2 account name>","Storage Account")
 dbutils.widgets.text("Event Hub Name","<your IoT Hub's Event Hub Compatible Name>","Event Hub Name")
+dbutils.widgets.text("Watermark Delay","1 hour","Watermark Delay")
 
 # COMMAND ----------
 
@@ -31,7 +32,7 @@ dbutils.widgets.text("Event Hub Name","<your IoT Hub's Event Hub Compatible Name
 # MAGIC * Azure Synapse SQL Pool call `iot`
 # MAGIC 
 # MAGIC ### Azure Databricks Configuration Required
-# MAGIC * 3-node (min) Databricks Cluster running **DBR 7.0+** and the following libraries:
+# MAGIC * 3-node (min) Databricks Cluster running **DBR 14.0+** (Python `StreamingQueryListener`, Delta Change Data Feed) and the following libraries:
 # MAGIC  * **Azure Event Hubs Connector for Databricks** - Maven coordinates `com.microsoft.azure:azure-eventhubs-spark_2.12:2.3.17`
 # MAGIC * The following Secrets defined in scope `iot`
 # MAGIC  * `iothub-cs` - Connection string for your IoT Hub **(Important - use the [Event Hub Compatible](https://devblogs.microsoft.com/iotdev/understand-different-connection-strings-in-azure-iot-hub/) connection string)**
@@ -65,6 +66,7 @@ SILVER_PATH = ROOT_PATH + "silver/"
 GOLD_PATH = ROOT_PATH + "gold/"
 SYNAPSE_PATH = ROOT_PATH + "synapse/"
 CHECKPOINT_PATH = ROOT_PATH + "checkpoints/"
+METRICS_PATH = ROOT_PATH + "metrics/"
 
 # Other initializations
 IOT_CS = dbutils.secrets.get('gsethi-kv-scope','iothub-cs')
@@ -78,13 +80,49 @@ ehConf = {
 spark.conf.set("spark.databricks.delta.optimizeWrite.enabled","true")
 spark.conf.set("spark.databricks.delta.autoCompact.enabled","true")
 
+# Keep streaming aggregation state in RocksDB instead of the JVM heap, and bound it with an event-time watermark
+spark.conf.set("spark.sql.streaming.stateStore.providerClass","com.databricks.sql.streaming.state.RocksDBStateStoreProvider")
+WATERMARK_DELAY = dbutils.widgets.get("Watermark Delay")
+
 # Pyspark and ML Imports
 import os, json, requests
 from pyspark.sql import functions as F
+from pyspark.sql.window import Window
 from pyspark.sql.functions import pandas_udf, PandasUDFType
 
 # COMMAND ----------
 
+import time
+from delta.tables import DeltaTable
+
+# Wait for a stream's first Delta commit at `path`, then register the external table once.
+# Sleeping in awaitTermination() keeps the driver idle and surfaces the stream's error if it fails before its first commit.
+def register_table_when_ready(table_name, path, query, timeout_s=600, initial_delay_s=1, max_delay_s=30):
+  deadline = time.time() + timeout_s
+  delay = initial_delay_s
+  while not DeltaTable.isDeltaTable(spark, path):
+    if time.time() > deadline:
+      raise TimeoutError(f"No Delta commit at {path} after {timeout_s}s, table {table_name} was not created")
+    if query.awaitTermination(delay):
+      raise RuntimeError(f"Stream {query.name or query.id} stopped before writing to {path}")
+    delay = min(delay * 2, max_delay_s)
+  spark.sql(f'CREATE TABLE IF NOT EXISTS {table_name} USING DELTA LOCATION "{path}"')
+
+# Wait until every table has at least one row, e.g. tables created up front that are filled by the given streams
+def wait_for_rows(table_names, queries, timeout_s=600, initial_delay_s=1, max_delay_s=30):
+  deadline = time.time() + timeout_s
+  delay = initial_delay_s
+  while any(spark.table(t).isEmpty() for t in table_names):
+    if time.time() > deadline:
+      raise TimeoutError(f"Tables {', '.join(table_names)} still have no rows after {timeout_s}s")
+    for query in queries:
+      if not query.isActive:
+        raise RuntimeError(f"Stream {query.name or query.id} stopped before writing to {', '.join(table_names)}")
+    time.sleep(delay)
+    delay = min(delay * 2, max_delay_s)
+
+# COMMAND ----------
+
 # Make sure root path is empty
 dbutils.fs.rm(ROOT_PATH, True)
 
@@ -105,8 +143,19 @@ dbutils.fs.rm(ROOT_PATH, True)
 # MAGIC DROP TABLE IF EXISTS turbine_maintenance;
 # MAGIC DROP VIEW IF EXISTS turbine_combined;
 # MAGIC DROP VIEW IF EXISTS feature_view;
+# MAGIC DROP TABLE IF EXISTS feature_table;
+# MAGIC DROP TABLE IF EXISTS feature_table_maintenance;
+# MAGIC DROP TABLE IF EXISTS feature_table_sources;
 # MAGIC DROP TABLE IF EXISTS turbine_life_predictions;
 # MAGIC DROP TABLE IF EXISTS turbine_power_predictions;
+# MAGIC DROP VIEW IF EXISTS turbine_predictions;
+# MAGIC DROP TABLE IF EXISTS turbine_model_metrics;
+# MAGIC DROP TABLE IF EXISTS turbine_champion_models;
+# MAGIC DROP TABLE IF EXISTS turbine_batch_predictions;
+# MAGIC DROP TABLE IF EXISTS turbine_optimal_settings;
+# MAGIC DROP TABLE IF EXISTS stream_state_metrics;
+# MAGIC DROP TABLE IF EXISTS stream_join_metrics;
+# MAGIC DROP TABLE IF EXISTS turbine_weather_station;
 
 # COMMAND ----------
 
@@ -125,7 +174,7 @@ dbutils.notebook.exit("stop")
 # MAGIC 1. **Turbine Sensor readings** - this payload contains `date`,`timestamp`,`deviceid`,`rpm` and `angle` fields
 # MAGIC 2. **Weather Sensor readings** - this payload contains `date`,`timestamp`,`temperature`,`humidity`,`windspeed`, and `winddirection` fields
 # MAGIC 
-# MAGIC We split out the two payloads into separate streams and write them both into Delta locations on Azure Storage. We are able to query these two Bronze tables *immediately* as the data streams in.
+# MAGIC We read and parse the IoT Hub stream once, and route the two payloads into separate Delta locations on Azure Storage from a single `foreachBatch()`. We are able to query these two Bronze tables *immediately* as the data streams in.
 
 # COMMAND ----------
 
@@ -141,33 +190,38 @@ iot_stream = (
     .select('reading.*', F.to_date('reading.timestamp').alias('date'))               # Create a "date" field for partitioning
 )
 
-# Split our IoT Hub stream into separate streams and write them both into their own Delta locations
-write_turbine_to_delta = (
-  iot_stream.filter('temperature is null')                                           # Filter out turbine telemetry from other data streams
-    .select('date','timestamp','deviceId','rpm','angle')                             # Extract the fields of interest
-    .writeStream.format('delta')                                                     # Write our stream to the Delta format
-    .partitionBy('date')                                                             # Partition our data by Date for performance
-    .option("checkpointLocation", CHECKPOINT_PATH + "turbine_raw")                   # Checkpoint so we can restart streams gracefully
-    .start(BRONZE_PATH + "turbine_raw")                                              # Stream the data into an ADLS Path
-)
+# Route each parsed message to the Delta location for its payload type, reading and parsing the IoT Hub stream only once
+def route_to_delta(routes, app_id):
+  def write_batch(batch_df, batch_id):
+    batch_df.persist()                                                               # Each route filters the same parsed micro-batch
+    try:
+      for path, (condition, columns) in routes.items():
+        (batch_df.filter(condition).select(*columns)
+          .write.format('delta').mode('append')
+          .partitionBy('date')                                                       # Partition our data by Date for performance
+          .option('txnAppId', app_id).option('txnVersion', batch_id)                 # Idempotent writes if a micro-batch is retried
+          .save(path))
+    finally:
+      batch_df.unpersist()
+  return write_batch
+
+iot_routes = {
+  BRONZE_PATH + "turbine_raw": ('temperature is null',                              # Turbine telemetry
+                                ['date','timestamp','deviceId','rpm','angle']),
+  BRONZE_PATH + "weather_raw": ('temperature is not null',                          # Weather telemetry
+                                ['date','deviceid','timestamp','temperature','humidity','windspeed','winddirection']),
+}
 
-write_weather_to_delta = (
-  iot_stream.filter(iot_stream.temperature.isNotNull())                              # Filter out weather telemetry only
-    .select('date','deviceid','timestamp','temperature','humidity','windspeed','winddirection') 
-    .writeStream.format('delta')                                                     # Write our stream to the Delta format
-    .partitionBy('date')                                                             # Partition our data by Date for performance
-    .option("checkpointLocation", CHECKPOINT_PATH + "weather_raw")                   # Checkpoint so we can restart streams gracefully
-    .start(BRONZE_PATH + "weather_raw")                                              # Stream the data into an ADLS Path
+write_iot_to_delta = (
+  iot_stream.writeStream
+    .foreachBatch(route_to_delta(iot_routes, 'iot_raw'))                             # Write every payload type from one micro-batch
+    .option("checkpointLocation", CHECKPOINT_PATH + "iot_raw")                       # One checkpoint for the single Event Hubs reader
+    .start()
 )
 
 # Create the external tables once data starts to stream in
-while True:
-  try:
-    spark.sql(f'CREATE TABLE IF NOT EXISTS turbine_raw USING DELTA LOCATION "{BRONZE_PATH + "turbine_raw"}"')
-    spark.sql(f'CREATE TABLE IF NOT EXISTS weather_raw USING DELTA LOCATION "{BRONZE_PATH + "weather_raw"}"')
-    break
-  except:
-    pass
+register_table_when_ready("turbine_raw", BRONZE_PATH + "turbine_raw", write_iot_to_delta)
+register_table_when_ready("weather_raw", BRONZE_PATH + "weather_raw", write_iot_to_delta)
 
 # COMMAND ----------
 
@@ -186,6 +240,78 @@ while True:
 
 # COMMAND ----------
 
+# MAGIC %md #### Monitoring Streaming State
+# MAGIC The watermarks used below let Spark drop the state of windows that can no longer receive data, so the state store stays bounded instead of growing for as long as the streams run. A `StreamingQueryListener` is registered before the streams start: the state store metrics of every progress report of a stateful stream (rows held in state, rows dropped by the watermark, memory used and commit latency) are buffered on the driver and appended to the `stream_state_metrics` Delta table every `STATE_METRICS_FLUSH_S` seconds, for as long as the streams run in this cluster.
+
+# COMMAND ----------
+
+import threading
+from pyspark.sql.streaming import StreamingQueryListener
+
+STATE_METRICS_FLUSH_S = 60    # How often the buffered state metrics are appended to Delta
+
+state_metrics_schema = "query_name string, query_id string, batch_id long, timestamp string, operator string, num_rows_total long, num_rows_updated long, num_rows_dropped_by_watermark long, memory_used_bytes long, commit_time_ms long, watermark string"
+
+spark.sql(f'CREATE TABLE IF NOT EXISTS stream_state_metrics ({state_metrics_schema.replace("timestamp string", "timestamp timestamp")}) USING DELTA LOCATION "{METRICS_PATH + "stream_state_metrics"}"')
+
+# Buffer the state operator metrics of every progress report as it is emitted, so the table has no gaps between reads.
+# The listener only appends to an in-memory buffer: writing to Delta on the listener bus would block it with one commit per trigger
+class StateMetricsListener(StreamingQueryListener):
+  def __init__(self):
+    self.rows = []
+    self.lock = threading.Lock()
+
+  def onQueryStarted(self, event):
+    pass
+
+  def onQueryProgress(self, event):
+    progress = json.loads(event.progress.json)
+    rows = [
+      (progress.get('name'), progress['id'], progress['batchId'], progress['timestamp'], op.get('operatorName'), op.get('numRowsTotal'), op.get('numRowsUpdated'),
+       op.get('numRowsDroppedByWatermark'), op.get('memoryUsedBytes'), op.get('commitTimeMs'), progress.get('eventTime', {}).get('watermark'))
+      for op in progress.get('stateOperators', [])
+    ]
+    with self.lock:
+      self.rows.extend(rows)
+
+  def onQueryIdle(self, event):
+    pass
+
+  def onQueryTerminated(self, event):
+    pass
+
+  # Append the buffered rows to Delta in a single commit; rows are put back in the buffer if the write fails
+  def flush(self):
+    with self.lock:
+      rows, self.rows = self.rows, []
+    if not rows:
+      return
+    try:
+      (spark.createDataFrame(rows, state_metrics_schema)
+        .withColumn('timestamp', F.to_timestamp('timestamp'))
+        .write.format('delta').mode('append').save(METRICS_PATH + "stream_state_metrics"))
+    except Exception as e:
+      print(f"Could not write stream state metrics, retrying in {STATE_METRICS_FLUSH_S}s: {e}")
+      with self.lock:
+        self.rows = rows + self.rows
+
+# Flush the buffer from a background thread on the driver until stop is set
+def flush_state_metrics(listener, stop):
+  while not stop.wait(STATE_METRICS_FLUSH_S):
+    listener.flush()
+  listener.flush()
+
+# Re-running this cell replaces the listener and its flush thread instead of adding a second one
+if 'state_metrics_listener' in globals():
+  spark.streams.removeListener(state_metrics_listener)
+  state_metrics_stop.set()
+state_metrics_listener = StateMetricsListener()
+state_metrics_stop = threading.Event()
+spark.streams.addListener(state_metrics_listener)
+threading.Thread(target=flush_state_metrics, args=(state_metrics_listener, state_metrics_stop), daemon=True).start()
+
+# COMMAND ----------
+
 # MAGIC %md ### 2a. Delta Bronze (Raw) to Delta Silver (Aggregated)
 # MAGIC The first step of our processing pipeline will clean and aggregate the measurements to 1 hour intervals. 
 # MAGIC 
@@ -196,58 +322,108 @@ while True:
 # MAGIC 2. Historical data needs to be backfilled while streaming data is feeding into the table
 # MAGIC 
 # MAGIC When streaming source data, `foreachBatch()` can be used to perform a merges on micro-batches of data.
+# MAGIC 
+# MAGIC `merge_delta` adds the dates (and window range) found in each micro-batch to the MERGE condition as literal predicates. Delta can then skip every partition and file the micro-batch cannot match, so the cost of each MERGE follows the size of the micro-batch rather than the size of the target table.
+# MAGIC 
+# MAGIC The Silver tables are created up front with [**Change Data Feed**](https://docs.microsoft.com/en-us/azure/databricks/delta/delta-change-data-feed) enabled. MERGE rewrites whole files, so the Gold stream reads the change feed instead of every row of every rewritten file.
 
 # COMMAND ----------
 
 # Create functions to merge turbine and weather data into their target Delta tables
-def merge_delta(incremental, target): 
-  incremental.dropDuplicates(['date','window','deviceid']).createOrReplaceTempView("incremental")
+def merge_delta(incremental, target, window_col=None): 
+  incremental = incremental.dropDuplicates(['date','window','deviceid']).persist()
   
   try:
-    # MERGE records into the target table using the specified join key
-    incremental._jdf.sparkSession().sql(f"""
-      MERGE INTO delta.`{target}` t
-      USING incremental i
-      ON i.date=t.date AND i.window = t.window AND i.deviceId = t.deviceid
-      WHEN MATCHED THEN UPDATE SET *
-      WHEN NOT MATCHED THEN INSERT *
-    """)
-  except:
-    # If the †arget table does not exist, create one
-    incremental.write.format("delta").partitionBy("date").save(target)
+    # Find the dates (and optionally the window range) in this micro-batch so the MERGE only scans those partitions.
+    # The window bounds are rendered as strings by Spark, so the literals below are read back in the same session time zone
+    window_bounds = [F.min(window_col).cast('string').alias('min_window'), F.max(window_col).cast('string').alias('max_window')] if window_col else []
+    bounds = incremental.agg(F.collect_set('date').alias('dates'), *window_bounds).first()
+    if not bounds['dates']:
+      return
+    partition_filter = "t.date IN ({})".format(", ".join(f"DATE'{d}'" for d in sorted(bounds['dates'])))
+    if window_col:
+      partition_filter += f" AND t.{window_col} BETWEEN TIMESTAMP'{bounds['min_window']}' AND TIMESTAMP'{bounds['max_window']}'"
+    
+    incremental.createOrReplaceTempView("incremental")
+    try:
+      # MERGE records into the target table using the specified join key
+      incremental._jdf.sparkSession().sql(f"""
+        MERGE INTO delta.`{target}` t
+        USING incremental i
+        ON {partition_filter} AND i.date=t.date AND i.window = t.window AND i.deviceId = t.deviceid
+        WHEN MATCHED THEN UPDATE SET *
+        WHEN NOT MATCHED THEN INSERT *
+      """)
+    except:
+      # If the †arget table does not exist, create one
+      incremental.write.format("delta").partitionBy("date").save(target)
+  finally:
+    incremental.unpersist()
     
+# Create the Silver tables with Change Data Feed enabled, so downstream streams can read only the rows each MERGE changed
+spark.sql(f"""
+  CREATE TABLE IF NOT EXISTS turbine_agg (deviceId string, date date, window struct<start:timestamp,end:timestamp>, rpm double, angle double)
+  USING DELTA PARTITIONED BY (date) LOCATION "{SILVER_PATH + "turbine_agg"}"
+  TBLPROPERTIES (delta.enableChangeDataFeed = true)
+""")
+spark.sql(f"""
+  CREATE TABLE IF NOT EXISTS weather_agg (date date, window struct<start:timestamp,end:timestamp>, deviceid string,
+    temperature double, humidity double, windspeed double, winddirection string)
+  USING DELTA PARTITIONED BY (date) LOCATION "{SILVER_PATH + "weather_agg"}"
+  TBLPROPERTIES (delta.enableChangeDataFeed = true)
+""")
+
+# Device-to-weather-station mapping, used as a broadcast dimension by the Gold join (2b). It is created here so the turbine
+# Silver stream can add turbines the first time they report
+spark.sql(f'CREATE TABLE IF NOT EXISTS turbine_weather_station (deviceid string, station_id string) USING DELTA LOCATION "{GOLD_PATH + "turbine_weather_station"}"')
+
+# Assign turbines missing from the mapping to the first reporting weather station, before their readings reach Silver and Gold
+def map_new_turbines(turbine_batch):
+  turbine_batch.select('deviceid').distinct().createOrReplaceTempView("reporting_turbines")
+  turbine_batch.sparkSession.sql("""
+    MERGE INTO turbine_weather_station t
+    USING (SELECT deviceid, (SELECT min(deviceid) FROM weather_agg) AS station_id FROM reporting_turbines) s
+    ON t.deviceid = s.deviceid
+    WHEN NOT MATCHED AND s.station_id IS NOT NULL THEN INSERT *
+  """)
+
+def merge_turbine_agg(incremental, batch_id):
+  map_new_turbines(incremental)
+  merge_delta(incremental, SILVER_PATH + "turbine_agg", "window.start")
+
 turbine_b_to_s = (
   spark.readStream.format('delta').table("turbine_raw")                        # Read data as a stream from our source Delta table
+    .withWatermark('timestamp', WATERMARK_DELAY)                               # Drop state for windows older than the watermark
     .groupBy('deviceId','date',F.window('timestamp','5 minutes'))              # Aggregate readings to hourly intervals
     .agg(F.avg('rpm').alias('rpm'), F.avg("angle").alias("angle"))
     .writeStream                                                               # Write the resulting stream
-    .foreachBatch(lambda i, b: merge_delta(i, SILVER_PATH + "turbine_agg"))    # Pass each micro-batch to a function
+    .foreachBatch(merge_turbine_agg)                                           # Map new turbines, then merge each micro-batch
     .outputMode("update")                                                      # Merge works with update mode
+    .queryName("turbine_agg")                                                  # Name the query so its state metrics are easy to find
     .option("checkpointLocation", CHECKPOINT_PATH + "turbine_agg")             # Checkpoint so we can restart streams gracefully
     .start()
 )
 
 weather_b_to_s = (
   spark.readStream.format('delta').table("weather_raw")                        # Read data as a stream from our source Delta table
+    .withWatermark('timestamp', WATERMARK_DELAY)                               # Drop state for windows older than the watermark
     .groupBy('deviceid','date',F.window('timestamp','5 minutes'))              # Aggregate readings to hourly intervals
     .agg({"temperature":"avg","humidity":"avg","windspeed":"avg","winddirection":"last"})
     .selectExpr('date','window','deviceid','`avg(temperature)` as temperature','`avg(humidity)` as humidity',
                 '`avg(windspeed)` as windspeed','`last(winddirection)` as winddirection')
     .writeStream                                                               # Write the resulting stream
-    .foreachBatch(lambda i, b: merge_delta(i, SILVER_PATH + "weather_agg"))    # Pass each micro-batch to a function
+    .foreachBatch(lambda i, b: merge_delta(i, SILVER_PATH + "weather_agg", "window.start"))  # Pass each micro-batch to a function
     .outputMode("update")                                                      # Merge works with update mode
+    .queryName("weather_agg")                                                  # Name the query so its state metrics are easy to find
     .option("checkpointLocation", CHECKPOINT_PATH + "weather_agg")             # Checkpoint so we can restart streams gracefully
     .start()
 )
 
-# Create the external tables once data starts to stream in
-while True:
-  try:
-    spark.sql(f'CREATE TABLE IF NOT EXISTS turbine_agg USING DELTA LOCATION "{SILVER_PATH + "turbine_agg"}"')
-    spark.sql(f'CREATE TABLE IF NOT EXISTS weather_agg USING DELTA LOCATION "{SILVER_PATH + "weather_agg"}"')
-    break
-  except:
-    pass
+# COMMAND ----------
+
+# MAGIC %sql
+# MAGIC -- State size and commit latency per stream over time
+# MAGIC SELECT query_name, timestamp, num_rows_total, num_rows_dropped_by_watermark, memory_used_bytes, commit_time_ms FROM stream_state_metrics ORDER BY query_name, timestamp DESC
 
 # COMMAND ----------
 
@@ -259,31 +435,82 @@ while True:
 
 # MAGIC %md ### 2b. Delta Silver (Aggregated) to Delta Gold (Enriched)
 # MAGIC Next we perform a streaming join of weather and turbine readings to create one enriched dataset we can use for data science and model training.
+# MAGIC 
+# MAGIC Each turbine is joined only with the readings of its own weather station, using the small `turbine_weather_station` dimension table (broadcast to every task). Both sides carry a watermark on the window start, so the join only keeps state for windows that can still receive data. Turbines without a row in `turbine_weather_station` would not be enriched, so the turbine Silver stream assigns every turbine that first reports to the first reporting weather station. Replace these rows with the real mapping as it becomes available. Both streams read the Change Data Feed of the Silver tables, and each micro-batch keeps only the row from the latest Silver commits of every turbine window before it is merged into Gold.
 
 # COMMAND ----------
 
-# Read streams from Delta Silver tables and join them together on common columns (date & window)
-turbine_agg = spark.readStream.format('delta').option("ignoreChanges", True).table('turbine_agg')
-weather_agg = spark.readStream.format('delta').option("ignoreChanges", True).table('weather_agg').drop('deviceid')
-turbine_enriched = turbine_agg.join(weather_agg, ['date','window'])
+# Until a real mapping is loaded, assign every turbine seen so far to the first reporting weather station.
+# The Silver tables are created empty up front, so wait for the Silver streams to write their first rows before seeding
+if spark.table('turbine_weather_station').isEmpty():
+  wait_for_rows(['turbine_agg', 'weather_agg'], [turbine_b_to_s, weather_b_to_s])
+  spark.sql("""
+    INSERT INTO turbine_weather_station
+    SELECT t.deviceid, (SELECT min(deviceid) FROM weather_agg) AS station_id FROM (SELECT DISTINCT deviceid FROM turbine_agg) t
+  """)
+
+# COMMAND ----------
+
+# Read the inserted and updated rows of a table from its Change Data Feed. A micro-batch can span several commits that
+# changed the same row, so the commit version is kept to pick the latest version of each row downstream
+def read_changes(table_name):
+  return (
+    spark.readStream.format('delta').option("readChangeFeed", True).table(table_name)
+      .filter("_change_type IN ('insert', 'update_postimage')")
+      .drop('_change_type', '_commit_timestamp')
+  )
+
+# Read streams from Delta Silver tables, attach each turbine's weather station and join the two streams on (station, window)
+turbine_agg = (
+  read_changes('turbine_agg')
+    .withColumn('window_start', F.col('window.start'))
+    .withWatermark('window_start', WATERMARK_DELAY)                                # Bound the join state kept for turbine windows
+    .join(F.broadcast(spark.table('turbine_weather_station')), 'deviceid')
+)
+weather_agg = (
+  read_changes('weather_agg')
+    .withColumnRenamed('deviceid', 'station_id')
+    .withColumnRenamed('_commit_version', '_weather_commit_version')
+    .withColumn('window_start', F.col('window.start'))
+    .withWatermark('window_start', WATERMARK_DELAY)                                # Bound the join state kept for weather windows
+    .drop('date', 'window')
+)
+turbine_enriched = turbine_agg.join(weather_agg, ['station_id','window_start'])
+
+# Record the join fan-out (output rows per turbine window, 1 when every turbine maps to one station) before merging into gold
+def merge_enriched(batch_df, batch_id):
+  batch_df.persist()
+  try:
+    (batch_df.agg(F.count('*').alias('output_rows'), F.countDistinct('deviceid','window').alias('turbine_windows'))
+      .select(F.lit(batch_id).alias('batch_id'), F.current_timestamp().alias('timestamp'), 'output_rows', 'turbine_windows',
+              (F.col('output_rows') / F.col('turbine_windows')).alias('fan_out'))
+      .write.format('delta').mode('append')
+      .option('txnAppId', 'turbine_enriched_join').option('txnVersion', batch_id)
+      .save(METRICS_PATH + "stream_join_metrics"))
+
+    # Keep only the row built from the latest turbine and weather commits of each (deviceid, window)
+    latest_first = Window.partitionBy('date','deviceid','window').orderBy(F.desc('_commit_version'), F.desc('_weather_commit_version'))
+    latest = batch_df.withColumn('rn', F.row_number().over(latest_first)).where('rn = 1') \
+      .drop('rn', '_commit_version', '_weather_commit_version')
+    merge_delta(latest, GOLD_PATH + "turbine_enriched", "window")
+  finally:
+    batch_df.unpersist()
 
 # Write the stream to a foreachBatch function which performs the MERGE as before
 merge_gold_stream = (
   turbine_enriched
-    .selectExpr('date','deviceid','window.start as window','rpm','angle','temperature','humidity','windspeed','winddirection')
+    .selectExpr('date','deviceid','window.start as window','rpm','angle','temperature','humidity','windspeed','winddirection',
+                '_commit_version','_weather_commit_version')
     .writeStream 
-    .foreachBatch(lambda i, b: merge_delta(i, GOLD_PATH + "turbine_enriched"))
+    .foreachBatch(merge_enriched)
+    .queryName("turbine_enriched")
     .option("checkpointLocation", CHECKPOINT_PATH + "turbine_enriched")         
     .start()
 )
 
 # Create the external tables once data starts to stream in
-while True:
-  try:
-    spark.sql(f'CREATE TABLE IF NOT EXISTS turbine_enriched USING DELTA LOCATION "{GOLD_PATH + "turbine_enriched"}"')
-    break
-  except:
-    pass
+register_table_when_ready("turbine_enriched", GOLD_PATH + "turbine_enriched", merge_gold_stream)
+register_table_when_ready("stream_join_metrics", METRICS_PATH + "stream_join_metrics", merge_gold_stream)
 
 # COMMAND ----------
 
@@ -291,6 +518,11 @@ while True:
 
 # COMMAND ----------
 
+# Join state size is recorded in stream_state_metrics by the listener; join fan-out per micro-batch is in stream_join_metrics
+display(spark.sql("SELECT * FROM stream_join_metrics ORDER BY batch_id DESC"))
+
+# COMMAND ----------
+
 # MAGIC %md ### 2c: Stream Delta GOLD Table to Synapse
 # MAGIC Synapse Analytics provides on-demand SQL directly on Data Lake source formats. Databricks can also directly stream data to Synapse SQL Pools for Data Warehousing workloads like BI dashboarding and reporting. 
 # MAGIC 
@@ -319,45 +551,60 @@ dbutils.notebook.exit("stop")
 
 # MAGIC %md ### 2d. Backfill Historical Data
 # MAGIC In order to train a model, we will need to backfill our streaming data with historical data. The cell below generates 1 year of historical hourly turbine and weather data and inserts it into our Gold Delta table.
+# MAGIC 
+# MAGIC The history is generated on the executors with `mapInPandas`, one task per device and 30-day chunk, and written to Delta in a single append. Each chunk is seeded from its device ID and offset, so re-running the backfill produces the same data.
 
 # COMMAND ----------
 
 import pandas as pd
 import numpy as np
+import zlib
 
 # Function to simulate generating time-series data given a baseline, slope, and some seasonality
-def generate_series(time_index, baseline, slope=0.01, period=365*24*12):
-  rnd = np.random.RandomState(time_index)
+def generate_series(time_index, baseline, rnd, slope=0.01, period=365*24*12):
   season_time = (time_index % period) / period
   seasonal_pattern = np.where(season_time < 0.4, np.cos(season_time * 2 * np.pi), 1 / np.exp(3 * season_time))
   return baseline * (1 + 0.1 * seasonal_pattern + 0.1 * rnd.randn(len(time_index)))
   
 # Get start and end dates for our historical data
 dates = spark.sql('select max(date)-interval 365 days as start, max(date) as end from turbine_enriched').toPandas()
-  
-# Get the baseline readings for each sensor for backfilling data
-turbine_enriched_pd = spark.table('turbine_enriched').toPandas()
-baselines = turbine_enriched_pd.min()[3:8]
-devices = turbine_enriched_pd['deviceid'].unique()
+backfill_start = pd.Timestamp(dates['start'][0])
+num_windows = len(pd.date_range(start=dates['start'][0], end=dates['end'][0], freq='1H'))   # Number of hourly timestamps from start to end date
+chunk_hours = 30 * 24
 
-# Iterate through each device to generate historical data for that device
+# Get the baseline readings for each sensor for backfilling data
+sensors = ['rpm','angle','temperature','humidity','windspeed']
+baselines = spark.table('turbine_enriched').agg(*[F.min(s).alias(s) for s in sensors]).first().asDict()
+
+# Generate the historical data of one device and 30-day chunk at a time; the seed is derived from both so every run produces the same series
+def generate_backfill(chunks):
+  for chunk in chunks:
+    for deviceid, offset in zip(chunk['deviceid'], chunk['offset']):
+      rnd = np.random.RandomState(zlib.crc32(f'{deviceid}:{offset}'.encode()))
+      time_index = np.arange(offset, min(offset + chunk_hours, num_windows))
+      windows = backfill_start + pd.to_timedelta(time_index, unit='h')
+      historical_values = pd.DataFrame({
+        'date': windows.date,
+        'window': windows, 
+        'winddirection': rnd.choice(['N','NW','W','SW','S','SE','E','NE'], size=len(windows)),
+        'deviceId': deviceid
+      })
+      for sensor in sensors:
+        historical_values[sensor] = generate_series(time_index, baselines[sensor], rnd)    # Generate time-series data from this sensor
+      yield historical_values
+
+backfill_schema = 'date date, window timestamp, winddirection string, deviceId string, ' + ', '.join(f'{s} double' for s in sensors)
+
+# Generate every device's history in parallel on the executors and write it to the enriched_readings Delta table in a single commit
 print("---Generating Historical Enriched Turbine Readings---")
-for deviceid in devices:
-  print(f'Backfilling device {deviceid}')
-  windows = pd.date_range(start=dates['start'][0], end=dates['end'][0], freq='1H') # Generate a list of hourly timestamps from start to end date
-  historical_values = pd.DataFrame({
-    'date': windows.date,
-    'window': windows, 
-    'winddirection': np.random.choice(['N','NW','W','SW','S','SE','E','NE'], size=len(windows)),
-    'deviceId': deviceid
-  })
-  time_index = historical_values.index.to_numpy()                                 # Generate a time index
-
-  for sensor in baselines.keys():
-    historical_values[sensor] = generate_series(time_index, baselines[sensor])    # Generate time-series data from this sensor
-
-  # Write dataframe to enriched_readings Delta table
-  spark.createDataFrame(historical_values).write.format("delta").mode("append").saveAsTable("turbine_enriched")
+backfill_chunks = (
+  spark.table('turbine_enriched').select('deviceid').distinct()
+    .crossJoin(spark.range(0, num_windows, chunk_hours).withColumnRenamed('id', 'offset'))
+    .repartition(sc.defaultParallelism)
+)
+(backfill_chunks.mapInPandas(generate_backfill, backfill_schema)
+  .repartition('date')                                                            # One well-sized file per date partition
+  .write.format("delta").mode("append").saveAsTable("turbine_enriched"))
   
 # Create power readings based on weather and operating conditions
 print("---Generating Historical Turbine Power Readings---")
@@ -20,6 +20,7 @@ dbutils.widgets.text("Subscription ID","<your Azure subscription ID>","Subscript
 dbutils.widgets.text("Resource Group","<your Azure resource group name>","Resource Group")
 dbutils.widgets.text("Region","<your Azure region>","Region")
 dbutils.widgets.text("Storage Account","<your ADLS Gen 2 account name>","Storage Account")
+dbutils.widgets.dropdown("Feature Build Mode","incremental",["full","incremental"],"Feature Build Mode")
 
 # COMMAND ----------
 
@@ -32,7 +33,7 @@ dbutils.widgets.text("Storage Account","<your ADLS Gen 2 account name>","Storage
 # MAGIC * Azure Machine Learning Workspace called `iot`
 # MAGIC 
 # MAGIC ### Azure Databricks Configuration Required
-# MAGIC * 3-node (min) Databricks Cluster running **DBR 7.0ML+** and the following libraries:
+# MAGIC * 3-node (min) Databricks Cluster running **DBR 14.0 ML+** (xgboost 1.7+, Delta `MERGE ... WHEN NOT MATCHED BY SOURCE`) and the following libraries:
 # MAGIC  * **MLflow[AzureML]** - PyPI library `azureml-mlflow`
 # MAGIC  * **Azure Event Hubs Connector for Databricks** - Maven coordinates `com.microsoft.azure:azure-eventhubs-spark_2.12:2.3.16`
 # MAGIC * The following Secrets defined in scope `iot`
@@ -65,6 +66,7 @@ ROOT_PATH = f"abfss://iot@{storage_account}.dfs.core.windows.net/"
 import os, json, requests
 from pyspark.sql import functions as F
 from pyspark.sql.functions import pandas_udf, PandasUDFType
+from pyspark.sql.types import StructType, StructField, DoubleType
 import numpy as np 
 import pandas as pd
 import xgboost as xgb
@@ -72,8 +74,11 @@ import mlflow.xgboost
 import mlflow.azureml
 from azureml.core import Workspace
 from azureml.core.webservice import AciWebservice, Webservice
-import random, string
+import random, string, shutil, sys, types
+from datetime import datetime
 from azureml.core.authentication import ServicePrincipalAuthentication
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Random String generator for ML models served in AzureML
 random_string = lambda length: ''.join(random.SystemRandom().choice(string.ascii_lowercase) for _ in range(length))
@@ -101,7 +106,7 @@ random_string = lambda length: ''.join(random.SystemRandom().choice(string.ascii
 # MAGIC %md ### 3a. Feature Engineering
 # MAGIC In order to predict power output 6 hours ahead, we need to first time-shift our data to create our label column. We can do this easily using Spark Window partitioning. 
 # MAGIC 
-# MAGIC In order to predict remaining life, we need to backtrace the remaining life from the maintenance events. We can do this easily using cross joins. The following diagram illustrates the ML Feature Engineering pipeline:
+# MAGIC In order to predict remaining life, we need to backtrace the remaining life from the maintenance events. We can do this in a single pass with an as-of join: for every reading date, window functions find the last and next maintenance of that turbine. The following diagram illustrates the ML Feature Engineering pipeline:
 # MAGIC 
 # MAGIC <img src="https://sguptasa.blob.core.windows.net/random/iiot_blog/ml_pipeline.png" width=800>
 
@@ -110,21 +115,111 @@ random_string = lambda length: ''.join(random.SystemRandom().choice(string.ascii
 # MAGIC %sql
 # MAGIC -- Calculate the age of each turbine and the remaining life in days
 # MAGIC CREATE OR REPLACE VIEW turbine_age AS
+# MAGIC -- As-of join: interleave reading dates and maintenance dates per turbine, then carry the last maintenance forward
+# MAGIC -- and the next maintenance backward with window functions (maintenance on the reading date counts for both)
 # MAGIC WITH reading_dates AS (SELECT distinct date, deviceid FROM turbine_power),
+# MAGIC   events AS (
+# MAGIC     SELECT deviceid, date, 1 AS is_reading, CAST(NULL AS DATE) AS maintenance_date FROM reading_dates
+# MAGIC     UNION ALL
+# MAGIC     SELECT deviceid, date, 0 AS is_reading, date AS maintenance_date FROM turbine_maintenance),
 # MAGIC   maintenance_dates AS (
-# MAGIC     SELECT d.*, datediff(nm.date, d.date) as datediff_next, datediff(d.date, lm.date) as datediff_last 
-# MAGIC     FROM reading_dates d LEFT JOIN turbine_maintenance nm ON (d.deviceid=nm.deviceid AND d.date<=nm.date)
-# MAGIC     LEFT JOIN turbine_maintenance lm ON (d.deviceid=lm.deviceid AND d.date>=lm.date ))
-# MAGIC SELECT date, deviceid, ifnull(min(datediff_last),0) AS age, ifnull(min(datediff_next),0) AS remaining_life
-# MAGIC FROM maintenance_dates 
-# MAGIC GROUP BY deviceid, date;
+# MAGIC     SELECT deviceid, date, is_reading,
+# MAGIC       last(maintenance_date, true) OVER (PARTITION BY deviceid ORDER BY date, is_reading ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS last_maintenance,
+# MAGIC       first(maintenance_date, true) OVER (PARTITION BY deviceid ORDER BY date, is_reading DESC ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING) AS next_maintenance
+# MAGIC     FROM events)
+# MAGIC SELECT date, deviceid, ifnull(datediff(date, last_maintenance),0) AS age, ifnull(datediff(next_maintenance, date),0) AS remaining_life
+# MAGIC FROM maintenance_dates
+# MAGIC WHERE is_reading = 1;
+
+# COMMAND ----------
+
+# MAGIC %md `feature_table` is a Delta table partitioned by date. In `incremental` Feature Build Mode, only the rows of each turbine affected by changed inputs are recomputed and merged into it:
+# MAGIC * rows from `LEAD_HORIZON_DAYS` before the earliest date whose readings were added, changed or removed since the last build (including backfilled and late readings), whose features or 6-hours-ahead label may change (rows whose readings were removed are deleted)
+# MAGIC * rows after the previous maintenance of any maintenance event added or removed since the last build, whose age and remaining life change
 # MAGIC 
-# MAGIC -- Calculate the power 6 hours ahead using Spark Windowing and build a feature_table to feed into our ML models
-# MAGIC CREATE OR REPLACE VIEW feature_table AS
-# MAGIC SELECT r.*, age, remaining_life,
-# MAGIC   LEAD(power, 72, power) OVER (PARTITION BY r.deviceid ORDER BY window) as power_6_hours_ahead
-# MAGIC FROM gold_readings r JOIN turbine_age a ON (r.date=a.date AND r.deviceid=a.deviceid)
-# MAGIC WHERE r.date < CURRENT_DATE();
+# MAGIC To detect these changes, every build keeps a fingerprint (row count and a hash of all values) of the readings of each turbine and date in `feature_table_sources`, and the maintenance events it used in `feature_table_maintenance`.
+
+# COMMAND ----------
+
+# Calculate the power 6 hours ahead using Spark Windowing and build a feature_table to feed into our ML models
+LEAD_HORIZON_DAYS = 3        # LEAD(power, 72) looks 72 readings ahead: 3 days of hourly readings
+
+feature_sql = """
+SELECT r.*, age, remaining_life,
+  LEAD(power, 72, power) OVER (PARTITION BY r.deviceid ORDER BY window) as power_6_hours_ahead
+FROM gold_readings r JOIN turbine_age a ON (r.date=a.date AND r.deviceid=a.deviceid)
+  {recompute_join}
+WHERE r.date < CURRENT_DATE()
+"""
+
+# Fingerprint of the readings of every turbine and date, compared with the one saved by the last build to find changed dates
+def source_fingerprints():
+  return spark.sql("""
+    SELECT deviceid, date, count(*) AS readings, bit_xor(xxhash64(*)) AS fingerprint
+    FROM gold_readings WHERE date < CURRENT_DATE()
+    GROUP BY deviceid, date
+  """)
+
+def build_feature_table_full():
+  spark.sql(f"CREATE OR REPLACE TABLE feature_table USING DELTA PARTITIONED BY (date) AS {feature_sql.format(recompute_join='')}")
+  spark.sql("CREATE OR REPLACE TABLE feature_table_maintenance USING DELTA AS SELECT * FROM turbine_maintenance")
+  source_fingerprints().write.format("delta").mode("overwrite").option("overwriteSchema", "true").saveAsTable("feature_table_sources")
+
+def build_feature_table_incremental():
+  # Keep the fingerprints compared below, so exactly these are saved for the next build
+  fingerprints = source_fingerprints().persist()
+  fingerprints.createOrReplaceTempView("feature_source_fingerprints")
+
+  # First date to recompute for each turbine: LEAD horizon before its earliest changed date, or the previous maintenance of a changed event
+  spark.sql(f"""
+    CREATE OR REPLACE TEMP VIEW feature_recompute_from AS
+    WITH changed_sources AS (
+        SELECT coalesce(c.deviceid, b.deviceid) AS deviceid, date_sub(min(coalesce(c.date, b.date)), {LEAD_HORIZON_DAYS}) AS from_date
+        FROM feature_source_fingerprints c FULL OUTER JOIN feature_table_sources b ON (c.deviceid=b.deviceid AND c.date=b.date)
+        WHERE c.readings IS DISTINCT FROM b.readings OR c.fingerprint IS DISTINCT FROM b.fingerprint
+        GROUP BY coalesce(c.deviceid, b.deviceid)),
+      changed_maintenance AS (
+        (SELECT * FROM turbine_maintenance EXCEPT SELECT * FROM feature_table_maintenance)
+        UNION (SELECT * FROM feature_table_maintenance EXCEPT SELECT * FROM turbine_maintenance)),
+      all_maintenance AS (
+        SELECT deviceid, date, lag(date) OVER (PARTITION BY deviceid ORDER BY date) AS previous_date
+        FROM (SELECT deviceid, date FROM turbine_maintenance UNION SELECT deviceid, date FROM feature_table_maintenance)),
+      maintenance_from AS (
+        SELECT c.deviceid, min(coalesce(m.previous_date, DATE'1900-01-01')) AS from_date
+        FROM changed_maintenance c JOIN all_maintenance m ON (c.deviceid=m.deviceid AND c.date=m.date)
+        GROUP BY c.deviceid)
+    SELECT deviceid, min(from_date) AS from_date
+    FROM (SELECT * FROM changed_sources UNION ALL SELECT * FROM maintenance_from)
+    GROUP BY deviceid
+  """)
+  min_from_date = spark.sql("SELECT min(from_date) FROM feature_recompute_from").first()[0]
+  if min_from_date is None:
+    fingerprints.unpersist()
+    return
+
+  # Rows of the recomputed range whose readings are gone are deleted; the predicate groups the turbines by their first recomputed date
+  recompute_ranges = spark.sql("SELECT from_date, collect_list(deviceid) AS deviceids FROM feature_recompute_from GROUP BY from_date").collect()
+  recompute_filter = " OR ".join(
+    f"""(t.date >= DATE'{r.from_date}' AND t.deviceid IN ({", ".join("'" + d.replace("'", "''") + "'" for d in r.deviceids)}))"""
+    for r in recompute_ranges)
+
+  spark.sql(f"CREATE OR REPLACE TEMP VIEW feature_updates AS {feature_sql.format(recompute_join='JOIN feature_recompute_from f ON (r.deviceid=f.deviceid AND r.date>=f.from_date)')}")
+  spark.sql(f"""
+    MERGE INTO feature_table t
+    USING feature_updates s
+    ON t.date >= DATE'{min_from_date}' AND t.deviceid = s.deviceid AND t.window = s.window
+    WHEN MATCHED THEN UPDATE SET *
+    WHEN NOT MATCHED THEN INSERT *
+    WHEN NOT MATCHED BY SOURCE AND t.date >= DATE'{min_from_date}' AND ({recompute_filter}) THEN DELETE
+  """)
+  spark.sql("INSERT OVERWRITE feature_table_maintenance SELECT * FROM turbine_maintenance")
+  fingerprints.write.format("delta").mode("overwrite").saveAsTable("feature_table_sources")
+  fingerprints.unpersist()
+
+if dbutils.widgets.get("Feature Build Mode") == "incremental" and spark.catalog.tableExists("feature_table_sources"):
+  build_feature_table_incremental()
+else:
+  build_feature_table_full()
 
 # COMMAND ----------
 
@@ -139,62 +234,146 @@ random_string = lambda length: ''.join(random.SystemRandom().choice(string.ascii
 # COMMAND ----------
 
 # MAGIC %md ### 3b. Distributed Model Training - Predict Power Output
-# MAGIC [Pandas UDFs](https://docs.microsoft.com/en-us/azure/databricks/spark/latest/spark-sql/udf-python-pandas?toc=https%3A%2F%2Fdocs.microsoft.com%2Fen-us%2Fazure%2Fazure-databricks%2Ftoc.json&bc=https%3A%2F%2Fdocs.microsoft.com%2Fen-us%2Fazure%2Fbread%2Ftoc.json) allow us to vectorize Pandas code across multiple nodes in a cluster. Here we create a UDF to train an XGBoost Regressor model against all the historic data for a particular Wind Turbine. We use a Grouped Map UDF as we perform this model training on the Wind Turbine group level.
+# MAGIC [Pandas UDFs](https://docs.microsoft.com/en-us/azure/databricks/spark/latest/spark-sql/udf-python-pandas?toc=https%3A%2F%2Fdocs.microsoft.com%2Fen-us%2Fazure%2Fazure-databricks%2Ftoc.json&bc=https%3A%2F%2Fdocs.microsoft.com%2Fen-us%2Fazure%2Fbread%2Ftoc.json) allow us to vectorize Pandas code across multiple nodes in a cluster. Here we create a function to train an XGBoost Regressor model against all the historic data for a particular Wind Turbine, and run it with `applyInPandas` as we perform this model training on the Wind Turbine group level. The most recent 20% of each turbine's readings are held out for early stopping.
 
 # COMMAND ----------
 
+# Train each model with as many XGBoost threads as Spark gives each task (spark.task.cpus), so concurrent tasks don't oversubscribe the executor cores
+TRAIN_THREADS = int(spark.conf.get("spark.task.cpus", "1"))
+XGB_PARAMS = {'learning_rate': 0.5, 'alpha':10, 'colsample_bytree': 0.5, 'max_depth': 5, 'nthread': TRAIN_THREADS}
+MAX_BOOST_ROUNDS = 200
+EARLY_STOPPING_ROUNDS = 10
+
+# Models are saved in MLflow format on DBFS by the executors; MLflow tracking happens once per model type on the driver
+MODELS_PATH = "dbfs:/iot/models/"
+training_run = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+
+# Load a saved model at most once per Python process. The cache lives in its own module in sys.modules, so on executors it
+# survives across tasks of the same (reused) Python worker instead of being shipped and rebuilt with every task
+def load_cached_model(model_uri):
+  cache = sys.modules.setdefault('iot_model_cache', types.ModuleType('iot_model_cache'))
+  if not hasattr(cache, 'models'):
+    cache.models = {}
+  if model_uri not in cache.models:
+    cache.models[model_uri] = mlflow.xgboost.load_model(model_uri.replace("dbfs:/", "/dbfs/"))
+  return cache.models[model_uri]
+
+# Predict with the trees up to the best iteration found by early stopping. A reloaded Booster only keeps it as a saved attribute
+# (xgboost 1.x does not restore the best_iteration property on load); without one, all trees are used
+def predict_best(model_uri, features_pd):
+  model = load_cached_model(model_uri)
+  best_iteration = model.attr('best_iteration')
+  iteration_range = (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)
+  return model.predict(xgb.DMatrix(features_pd), iteration_range=iteration_range)
+
 # Create a function to train a XGBoost Regressor on a turbine's data
 def train_distributed_xgb(readings_pd, model_type, label_col, prediction_col):
-  mlflow.xgboost.autolog()
-  with mlflow.start_run():
-    # Log the model type and device ID
-    mlflow.log_param('deviceid', readings_pd['deviceid'][0])
-    mlflow.log_param('model', model_type)
-
-    # Train an XGBRegressor on the data for this Turbine
-    alg = xgb.XGBRegressor() 
-    train_dmatrix = xgb.DMatrix(data=readings_pd[feature_cols].astype('float'),label=readings_pd[label_col])
-    params = {'learning_rate': 0.5, 'alpha':10, 'colsample_bytree': 0.5, 'max_depth': 5}
-    model = xgb.train(params=params, dtrain=train_dmatrix, evals=[(train_dmatrix, 'train')])
-
-    # Make predictions on the dataset and return the results
-    readings_pd[prediction_col] = model.predict(train_dmatrix)
-  return readings_pd
+  deviceid = readings_pd['deviceid'].iloc[0]
+
+  # Hold out the most recent 20% of this Turbine's readings for early stopping
+  readings_pd = readings_pd.sort_values('window').reset_index(drop=True)
+  split = max(1, int(len(readings_pd) * 0.8))
+  features = readings_pd[feature_cols].astype('float')
+  train_dmatrix = xgb.DMatrix(data=features[:split], label=readings_pd[label_col][:split])
+  valid_dmatrix = xgb.DMatrix(data=features[split:], label=readings_pd[label_col][split:]) if split < len(readings_pd) else train_dmatrix
+
+  # Train an XGBoost regressor on the data for this Turbine
+  evals_result = {}
+  model = xgb.train(params=XGB_PARAMS, dtrain=train_dmatrix, num_boost_round=MAX_BOOST_ROUNDS,
+                    evals=[(train_dmatrix, 'train'), (valid_dmatrix, 'valid')], early_stopping_rounds=EARLY_STOPPING_ROUNDS,
+                    evals_result=evals_result, verbose_eval=False)
+
+  # Save the model and its metrics without any round-trip to the MLflow tracking server
+  model_uri = f"{MODELS_PATH}{training_run}/{model_type}/{deviceid}"
+  local_path = model_uri.replace("dbfs:/", "/dbfs/")
+  shutil.rmtree(local_path, ignore_errors=True)                 # A retried task overwrites the model of the failed attempt
+  mlflow.xgboost.save_model(model, local_path)
+  with open(f"{local_path}/metrics.json", "w") as f:
+    json.dump({'deviceid': deviceid, 'model': model_type, 'training_run': training_run, 'model_uri': model_uri,
+               'best_iteration': model.best_iteration,
+               'train_rmse': evals_result['train']['rmse'][model.best_iteration],
+               'valid_rmse': evals_result['valid']['rmse'][model.best_iteration]}, f)
+
+  # Make predictions on the dataset and return only the keys, the predictions and the model they came from
+  return pd.DataFrame({
+    'deviceid': readings_pd['deviceid'],
+    'date': readings_pd['date'],
+    'window': readings_pd['window'],
+    prediction_col: model.predict(xgb.DMatrix(features), iteration_range=(0, model.best_iteration + 1)),
+    'model_uri': model_uri
+  })
+
+# Output of the training function: predictions are joined back to the features on (deviceid, date, window) when they are read
+def prediction_schema(prediction_col):
+  return f'deviceid string, date date, window timestamp, {prediction_col} double, model_uri string'
+
+# Champion-model index: one row per (deviceid, model) with the URI of the best model trained so far (min validation RMSE)
+spark.sql("""
+  CREATE TABLE IF NOT EXISTS turbine_champion_models
+  (deviceid string, model string, model_uri string, valid_rmse double, training_run string, updated_at timestamp)
+  USING DELTA
+""")
+
+def update_champions(metrics):
+  metrics.createOrReplaceTempView("turbine_model_candidates")
+  spark.sql("""
+    MERGE INTO turbine_champion_models t
+    USING turbine_model_candidates s
+    ON t.deviceid = s.deviceid AND t.model = s.model
+    WHEN MATCHED AND s.valid_rmse < t.valid_rmse THEN
+      UPDATE SET model_uri = s.model_uri, valid_rmse = s.valid_rmse, training_run = s.training_run, updated_at = current_timestamp()
+    WHEN NOT MATCHED THEN
+      INSERT (deviceid, model, model_uri, valid_rmse, training_run, updated_at)
+      VALUES (s.deviceid, s.model, s.model_uri, s.valid_rmse, s.training_run, current_timestamp())
+  """)
+
+# Collect the metrics the executors saved next to each model into a Delta table, update the champion index, and log one MLflow run for the whole model type
+def log_training_run(model_type):
+  metrics = spark.read.json(f"{MODELS_PATH}{training_run}/{model_type}/*/metrics.json")
+  metrics.write.format("delta").mode("append").option("mergeSchema", "true").saveAsTable("turbine_model_metrics")
+  update_champions(metrics)
+  summary = metrics.agg(F.count('*').alias('models'), F.avg('train_rmse').alias('train_rmse'), F.avg('valid_rmse').alias('valid_rmse')).first()
+  with mlflow.start_run(run_name=f"{model_type}_{training_run}"):
+    mlflow.log_params({**XGB_PARAMS, 'model': model_type, 'training_run': training_run, 'models_path': f"{MODELS_PATH}{training_run}/{model_type}"})
+    mlflow.log_metrics({'models': summary['models'], 'avg_train_rmse': summary['train_rmse'], 'avg_valid_rmse': summary['valid_rmse']})
 
 # Create a Spark Dataframe that contains the features and labels we need
-non_feature_cols = ['date','window','deviceid','winddirection','remaining_life']
+key_cols = ['date','window','deviceid']
 feature_cols = ['angle','rpm','temperature','humidity','windspeed','power','age']
 label_col = 'power_6_hours_ahead'
 prediction_col = label_col + '_predicted'
 
 # Read in our feature table and select the columns of interest
-feature_df = spark.table('feature_table').selectExpr(non_feature_cols + feature_cols + [label_col] + [f'0 as {prediction_col}'])
+feature_df = spark.table('feature_table').select(key_cols + feature_cols + [label_col])
 
-# Register a Pandas UDF to distribute XGB model training using Spark
-@pandas_udf(feature_df.schema, PandasUDFType.GROUPED_MAP)
+# Distribute XGB model training using Spark
 def train_power_models(readings_pd):
   return train_distributed_xgb(readings_pd, 'power_prediction', label_col, prediction_col)
 
-# Run the Pandas UDF against our feature dataset - this will train 1 model for each turbine
-power_predictions = feature_df.groupBy('deviceid').apply(train_power_models)
+# Run the training function against our feature dataset - this will train 1 model for each turbine
+power_predictions = feature_df.groupBy('deviceid').applyInPandas(train_power_models, schema=prediction_schema(prediction_col))
 
 # Save predictions to storage
-power_predictions.write.format("delta").mode("overwrite").partitionBy("date").saveAsTable("turbine_power_predictions")
+power_predictions.write.format("delta").mode("overwrite").option("overwriteSchema", "true").partitionBy("date").saveAsTable("turbine_power_predictions")
+log_training_run('power_prediction')
 
 # COMMAND ----------
 
 # MAGIC %sql 
 # MAGIC -- Plot actuals vs. predicted
-# MAGIC SELECT date, deviceid, avg(power_6_hours_ahead) as actual, avg(power_6_hours_ahead_predicted) as predicted FROM turbine_power_predictions GROUP BY date, deviceid
+# MAGIC SELECT f.date, f.deviceid, avg(f.power_6_hours_ahead) as actual, avg(p.power_6_hours_ahead_predicted) as predicted 
+# MAGIC FROM feature_table f JOIN turbine_power_predictions p ON (f.date=p.date AND f.window=p.window AND f.deviceid=p.deviceid)
+# MAGIC GROUP BY f.date, f.deviceid
 
 # COMMAND ----------
 
-# MAGIC %md #### Automated Model Tracking in Databricks
-# MAGIC As you train the models, notice how Databricks-managed MLflow automatically tracks each run in the "Runs" tab of the notebook. You can open each run and view the parameters, metrics, models and model artifacts that are captured by MLflow Autologging. For XGBoost Regression models, MLflow tracks: 
-# MAGIC 1. Any model parameters (alpha, colsample, learning rate, etc.) passed to the `params` variable
-# MAGIC 2. Metrics specified in `evals` (RMSE by default)
-# MAGIC 3. The trained XGBoost model file
-# MAGIC 4. Feature importances
+# MAGIC %md #### Model Tracking in Databricks
+# MAGIC Training thousands of turbine models with one MLflow run each spends most of its time in round-trips to the tracking server. Instead, every task saves its model in MLflow format under `MODELS_PATH`, together with its metrics, and the driver logs a single run per model type in the "Runs" tab of the notebook. Each of these runs tracks:
+# MAGIC 1. The model parameters (alpha, colsample, learning rate, etc.) in `XGB_PARAMS`
+# MAGIC 2. The average train and validation RMSE across all turbines
+# MAGIC 3. The location of the trained XGBoost models
+# MAGIC 
+# MAGIC The metrics of each individual turbine model (best iteration after early stopping, train and validation RMSE and model URI) are stored in the `turbine_model_metrics` Delta table. The `turbine_champion_models` Delta table is updated at the same time and keeps a single row per turbine and model type: the URI of the model with the lowest validation RMSE across all training runs. Deployment and batch scoring look models up there instead of searching through MLflow runs.
 # MAGIC 
 # MAGIC <img src="https://sguptasa.blob.core.windows.net/random/iiot_blog/iiot_mlflow_tracking.gif" width=800>
 
@@ -208,37 +387,111 @@ power_predictions.write.format("delta").mode("overwrite").partitionBy("date").sa
 # COMMAND ----------
 
 # Create a Spark Dataframe that contains the features and labels we need
-non_feature_cols = ['date','window','deviceid','winddirection','power_6_hours_ahead_predicted']
 label_col = 'remaining_life'
 prediction_col = label_col + '_predicted'
 
 # Read in our feature table and select the columns of interest
-feature_df = spark.table('turbine_power_predictions').selectExpr(non_feature_cols + feature_cols + [label_col] + [f'0 as {prediction_col}'])
+feature_df = spark.table('feature_table').select(key_cols + feature_cols + [label_col])
 
-# Register a Pandas UDF to distribute XGB model training using Spark
-@pandas_udf(feature_df.schema, PandasUDFType.GROUPED_MAP)
+# Distribute XGB model training using Spark
 def train_life_models(readings_pd):
   return train_distributed_xgb(readings_pd, 'life_prediction', label_col, prediction_col)
 
-# Run the Pandas UDF against our feature dataset - this will train 1 model per turbine and write the predictions to a table
+# Run the training function against our feature dataset - this will train 1 model per turbine and write the predictions to a table
 life_predictions = (
-  feature_df.groupBy('deviceid').apply(train_life_models)
-    .write.format("delta").mode("overwrite")
+  feature_df.groupBy('deviceid').applyInPandas(train_life_models, schema=prediction_schema(prediction_col))
+    .write.format("delta").mode("overwrite").option("overwriteSchema", "true")
     .partitionBy("date")
     .saveAsTable("turbine_life_predictions")
 )
+log_training_run('life_prediction')
 
 # COMMAND ----------
 
-# MAGIC %sql 
+# MAGIC %sql
+# MAGIC -- The prediction tables only hold keys, predictions and model URIs; join them back to the features when reading
+# MAGIC CREATE OR REPLACE VIEW turbine_predictions AS
+# MAGIC SELECT f.*, p.power_6_hours_ahead_predicted, l.remaining_life_predicted, p.model_uri AS power_model_uri, l.model_uri AS life_model_uri
+# MAGIC FROM feature_table f
+# MAGIC   LEFT JOIN turbine_power_predictions p ON (f.date=p.date AND f.window=p.window AND f.deviceid=p.deviceid)
+# MAGIC   LEFT JOIN turbine_life_predictions l ON (f.date=l.date AND f.window=l.window AND f.deviceid=l.deviceid);
+# MAGIC 
 # MAGIC SELECT date, avg(remaining_life) as Actual_Life, avg(remaining_life_predicted) as Predicted_Life 
-# MAGIC FROM turbine_life_predictions 
+# MAGIC FROM turbine_predictions 
 # MAGIC WHERE deviceid='WindTurbine-1' 
 # MAGIC GROUP BY date ORDER BY date
 
 # COMMAND ----------
 
-# MAGIC %md The models to predict remaining useful life have been trained and logged by MLflow. We can now move on to model deployment in AzureML.
+# MAGIC %md The models to predict remaining useful life have been trained, and their metrics logged to MLflow and `turbine_model_metrics`. We can now move on to model deployment in AzureML.
+
+# COMMAND ----------
+
+# MAGIC %md ### 3d. Batch Inference in Databricks
+# MAGIC Data that is already in Delta does not need to go through a REST endpoint to be scored. The champion power and life models of every turbine are loaded on the executors (once per Python worker, through `load_cached_model`) and score `feature_table` directly with `mapInPandas`. Every prediction keeps a hash of the features it was computed from and the URIs of the models that computed it. On a re-run, only readings that are new, whose features changed (for example age after a maintenance edit rebuilt them in `feature_table`), or whose turbine has a new champion model are scored, and they are MERGED into the `turbine_batch_predictions` Delta table.
+
+# COMMAND ----------
+
+batch_prediction_schema = 'deviceid string, date date, window timestamp, feature_hash long, power_6_hours_ahead_predicted double, remaining_life_predicted double, power_model_uri string, life_model_uri string'
+
+# Score each turbine's readings with its champion models; rows are grouped by model so every model predicts one vectorized batch
+def score_with_champions(batches):
+  for pdf in batches:
+    for (power_uri, life_uri), readings in pdf.groupby(['power_model_uri', 'life_model_uri']):
+      features = readings[feature_cols].astype('float')
+      yield pd.DataFrame({
+        'deviceid': readings['deviceid'],
+        'date': readings['date'],
+        'window': readings['window'],
+        'feature_hash': readings['feature_hash'],
+        'power_6_hours_ahead_predicted': predict_best(power_uri, features),
+        'remaining_life_predicted': predict_best(life_uri, features),
+        'power_model_uri': power_uri,
+        'life_model_uri': life_uri
+      })
+
+# Champion power and life model URIs of every turbine that has both
+def champion_models():
+  return spark.sql("""
+    SELECT deviceid,
+      first(model_uri) FILTER (WHERE model = 'power_prediction') AS power_model_uri,
+      first(model_uri) FILTER (WHERE model = 'life_prediction') AS life_model_uri
+    FROM turbine_champion_models
+    GROUP BY deviceid
+  """).where('power_model_uri IS NOT NULL AND life_model_uri IS NOT NULL')
+
+def batch_score_features():
+  readings = spark.table('feature_table').select(key_cols + feature_cols) \
+    .withColumn('feature_hash', F.xxhash64(*feature_cols)) \
+    .join(champion_models(), 'deviceid')
+
+  if not spark.catalog.tableExists('turbine_batch_predictions'):
+    scores = readings.repartition('deviceid').mapInPandas(score_with_champions, schema=batch_prediction_schema)
+    scores.write.format("delta").partitionBy("date").saveAsTable("turbine_batch_predictions")
+    return
+
+  # Only score the readings without a prediction from the same features and the current champion models
+  scored_cols = key_cols + ['feature_hash', 'power_model_uri', 'life_model_uri']
+  changed_readings = readings.join(spark.table('turbine_batch_predictions').select(scored_cols), scored_cols, 'left_anti')
+  changed_readings.repartition('deviceid').mapInPandas(score_with_champions, schema=batch_prediction_schema) \
+    .createOrReplaceTempView('turbine_batch_scores')
+  spark.sql("""
+    MERGE INTO turbine_batch_predictions t
+    USING turbine_batch_scores s
+    ON t.date = s.date AND t.window = s.window AND t.deviceid = s.deviceid
+    WHEN MATCHED THEN UPDATE SET *
+    WHEN NOT MATCHED THEN INSERT *
+  """)
+
+batch_score_features()
+
+# COMMAND ----------
+
+# MAGIC %sql
+# MAGIC SELECT date, avg(power_6_hours_ahead_predicted) as Predicted_Power, avg(remaining_life_predicted) as Predicted_Life
+# MAGIC FROM turbine_batch_predictions
+# MAGIC WHERE deviceid='WindTurbine-1'
+# MAGIC GROUP BY date ORDER BY date
 
 # COMMAND ----------
 
@@ -277,11 +530,16 @@ workspace = Workspace.create(name = aml_workspace_name,
                              auth=sp,
                              exist_ok=True)
 
-# Retrieve the remaining_life and power_output experiments on WindTurbine-1, and get the best performing model (min RMSE)
-best_life_model = mlflow.search_runs(filter_string=f'params.deviceid="{turbine}" and params.model="{life_model}"')\
-  .dropna().sort_values("metrics.train-rmse")['artifact_uri'].iloc[0] + '/model'
-best_power_model = mlflow.search_runs(filter_string=f'params.deviceid="{turbine}" and params.model="{power_model}"')\
-  .dropna().sort_values("metrics.train-rmse")['artifact_uri'].iloc[0] + '/model'
+# Retrieve the best performing (min validation RMSE) remaining_life and power_output models of WindTurbine-1 from the champion index
+def champion_model_uri(deviceid, model_type):
+  champion = spark.table('turbine_champion_models').where(F.col('deviceid') == deviceid).where(F.col('model') == model_type) \
+    .select('model_uri').first()
+  if champion is None:
+    raise ValueError(f"No champion {model_type} model for {deviceid} in turbine_champion_models, train its models first (Step 3)")
+  return champion['model_uri']
+
+best_life_model = champion_model_uri(turbine, life_model)
+best_power_model = champion_model_uri(turbine, power_model)
 
 scoring_uris = {}
 for model, path in [('life',best_life_model),('power',best_power_model)]:
@@ -339,10 +597,48 @@ payload = {
   'age':10
 }
 
+class ScoringClient:
+  """Scores rows against an AzureML REST endpoint, sending up to batch_size rows per request over a pooled Session."""
+  def __init__(self, uri, batch_size=1000, timeout=60, pool_size=4, retries=3):
+    self.uri, self.batch_size, self.timeout = uri, batch_size, timeout
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], allowed_methods=None))
+    self.session = requests.Session()
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.session.headers.update({"Content-Type": "application/json"})
+
+  def score(self, rows):
+    predictions = []
+    for start in range(0, len(rows), self.batch_size):
+      response = self.session.post(self.uri, data=json.dumps({"data": rows[start:start + self.batch_size]}), timeout=self.timeout)
+      response.raise_for_status()
+      predictions.extend(json.loads(response.text))
+    return predictions
+
+  def score_frame(self, pdf, feature_cols):
+    return pd.Series(self.score(pdf[feature_cols].astype(float).values.tolist()), index=pdf.index, dtype='float64')
+
+# One client (and connection pool) per endpoint, reused by every call on the driver
+scoring_clients = {}
+def scoring_client(uri):
+  if uri not in scoring_clients:
+    scoring_clients[uri] = ScoringClient(uri)
+  return scoring_clients[uri]
+
 def score_data(uri, payload):
-  rest_payload = json.dumps({"data": [list(payload.values())]})
-  response = requests.post(uri, data=rest_payload, headers={"Content-Type": "application/json"})
-  return json.loads(response.text)
+  return scoring_client(uri).score([list(payload.values())])
+
+def score_with_endpoint(df, uri, feature_cols, prediction_col, batch_size=1000):
+  """Bulk-scores a Spark DataFrame with mapInPandas: each task opens one Session and sends batch_size rows per request."""
+  schema = StructType(df.schema.fields + [StructField(prediction_col, DoubleType())])
+  def score_partition(batches):
+    client = ScoringClient(uri, batch_size)
+    for pdf in batches:
+      if len(pdf):
+        pdf[prediction_col] = client.score_frame(pdf, feature_cols)
+        yield pdf
+  return df.mapInPandas(score_partition, schema)
 
 print(f'Current Operating Parameters: {payload}')
 print(f'Predicted power (in kwh) from model: {score_data(power_uri, payload)}')
@@ -350,6 +646,41 @@ print(f'Predicted remaining life (in days) from model: {score_data(life_uri, pay
 
 # COMMAND ----------
 
+# MAGIC %md The scoring client can be checked without AzureML by pointing it at a local stand-in endpoint that accepts the same `{"data": [...]}` format (here it returns the sum of each row), both row by row on the driver and in bulk through `score_with_endpoint`
+
+# COMMAND ----------
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StandInScoringHandler(BaseHTTPRequestHandler):
+  def do_POST(self):
+    rows = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['data']
+    body = json.dumps([float(sum(row)) for row in rows]).encode()
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+  def log_message(self, *args):
+    pass
+
+# The stand-in listens on the driver's address, so the executors running score_with_endpoint can reach it too
+stand_in = ThreadingHTTPServer(('0.0.0.0', 0), StandInScoringHandler)
+threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+stand_in_uri = f'http://{spark.conf.get("spark.driver.host")}:{stand_in.server_port}/score'
+try:
+  stand_in_client = ScoringClient(stand_in_uri, batch_size=2)
+  assert stand_in_client.score([[1, 2], [3, 4], [5, 6]]) == [3.0, 7.0, 11.0]
+
+  stand_in_df = spark.createDataFrame([(1.0, 2.0), (3.0, 4.0), (5.0, 6.0)], 'a double, b double')
+  stand_in_scores = score_with_endpoint(stand_in_df, stand_in_uri, ['a', 'b'], 'prediction', batch_size=2).orderBy('a').collect()
+  assert [r['prediction'] for r in stand_in_scores] == [3.0, 7.0, 11.0]
+finally:
+  stand_in.shutdown()
+
+# COMMAND ----------
+
 # MAGIC %md ### Step 6: Asset Optimization
 # MAGIC We can now identify the optimal operating conditions for maximizing power output while also maximizing asset useful life. 
 # MAGIC 
@@ -374,17 +705,14 @@ payload = {
   'age':10
 }
 
-# Iterate through 50 different RPM configurations and capture the predicted power and remaining life at each RPM
-results = []
-for rpm in range(1,15):
-  payload['rpm'] = rpm
-  expected_power = score_data(power_uri, payload)[0]
-  payload['power'] = expected_power
-  expected_life = -score_data(life_uri, payload)[0]
-  results.append((rpm, expected_power, expected_life))
-  
+# Score every RPM configuration in one request per model: predicted power first, then remaining life given that power
+scenarios = pd.DataFrame([{**payload, 'rpm': rpm} for rpm in range(1,15)])
+payload_cols = list(payload.keys())
+scenarios['power'] = scoring_client(power_uri).score_frame(scenarios, payload_cols)
+scenarios['life'] = -scoring_client(life_uri).score_frame(scenarios, payload_cols)
+
 # Calculalte the Revenue, Cost and Profit generated for each RPM configuration
-optimization_df = pd.DataFrame(results, columns=['RPM', 'Expected Power', 'Expected Life'])
+optimization_df = scenarios[['rpm', 'power', 'life']].set_axis(['RPM', 'Expected Power', 'Expected Life'], axis=1)
 optimization_df['Revenue'] = optimization_df['Expected Power'] * 24 * 365
 optimization_df['Cost'] = optimization_df['Expected Power'] * 24 * 365 / optimization_df['Expected Life']
 optimization_df['Profit'] = optimization_df['Revenue'] + optimization_df['Cost']
@@ -397,6 +725,66 @@ display(optimization_df)
 
 # COMMAND ----------
 
+# MAGIC %md #### Fleet-wide Optimization
+# MAGIC Scoring one turbine and one weather scenario through the REST endpoints does not scale to the whole fleet. Instead, each turbine's champion power and life models (from `turbine_champion_models`) are loaded directly from `MODELS_PATH` on the executors, once per Python worker, and `applyInPandas` scores the full grid of RPM × angle × weather scenario for that turbine in two vectorized predictions. Revenue, Cost and Profit are computed with NumPy over the whole grid, and the most profitable setting of every turbine and weather scenario is written to the `turbine_optimal_settings` Delta table.
+
+# COMMAND ----------
+
+# Operating settings and weather scenarios to evaluate for every turbine
+RPM_RANGE = np.arange(1, 15)
+ANGLE_RANGE = np.arange(2, 15, 2)
+weather_scenarios = pd.DataFrame([
+  {'scenario': 'calm',     'temperature': 25, 'humidity': 50, 'windspeed': 2},
+  {'scenario': 'baseline', 'temperature': 25, 'humidity': 50, 'windspeed': 5},
+  {'scenario': 'windy',    'temperature': 20, 'humidity': 60, 'windspeed': 10},
+  {'scenario': 'hot',      'temperature': 35, 'humidity': 30, 'windspeed': 5}
+])
+
+# Score every RPM x angle x weather scenario of one turbine (one row with its current power, age and model URIs) and compute Profit
+def optimize_turbine(turbine_pd, full_grid=False):
+  turbine = turbine_pd.iloc[0]
+  rpm, angle, scenario = [a.ravel() for a in np.meshgrid(RPM_RANGE, ANGLE_RANGE, np.arange(len(weather_scenarios)), indexing='ij')]
+  grid = weather_scenarios.iloc[scenario].reset_index(drop=True)
+  grid['deviceid'], grid['rpm'], grid['angle'] = turbine['deviceid'], rpm.astype('float'), angle.astype('float')
+  grid['power'], grid['age'] = float(turbine['power']), float(turbine['age'])
+
+  # Predicted power first, then remaining life given that power
+  grid['power'] = predict_best(turbine['power_model_uri'], grid[feature_cols].astype('float'))
+  grid['life'] = -predict_best(turbine['life_model_uri'], grid[feature_cols].astype('float'))
+
+  yearly_power = grid['power'].to_numpy() * 24 * 365
+  grid['revenue'] = yearly_power
+  grid['cost'] = yearly_power / grid['life'].to_numpy()
+  grid['profit'] = grid['revenue'] + grid['cost']
+  if full_grid:
+    return grid
+  best = grid.groupby('scenario')['profit'].idxmax()
+  return grid.loc[best, optimal_settings_cols]
+
+optimal_settings_cols = ['deviceid','scenario','temperature','humidity','windspeed','rpm','angle','power','life','revenue','cost','profit']
+optimal_settings_schema = 'deviceid string, scenario string, temperature double, humidity double, windspeed double, rpm double, angle double, power double, life double, revenue double, cost double, profit double'
+
+# Current power and age of every turbine, together with the URIs of its champion power and life models
+latest_readings = spark.sql("""
+  SELECT deviceid, power, age FROM (
+    SELECT deviceid, power, age, row_number() OVER (PARTITION BY deviceid ORDER BY window DESC) AS rn FROM feature_table
+  ) WHERE rn = 1
+""")
+turbines = latest_readings.join(champion_models(), 'deviceid')
+
+# One task per turbine: the argmax of every weather scenario is written to Delta in a single job
+turbines.groupBy('deviceid').applyInPandas(optimize_turbine, schema=optimal_settings_schema) \
+  .write.format("delta").mode("overwrite").option("overwriteSchema", "true").saveAsTable("turbine_optimal_settings")
+
+display(spark.table('turbine_optimal_settings').orderBy('deviceid', 'scenario'))
+
+# COMMAND ----------
+
+# The same engine returns the whole grid of a single turbine, e.g. to plot Profit against RPM and angle
+display(optimize_turbine(turbines.where(F.col('deviceid') == turbine).toPandas(), full_grid=True))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ### Step 7: Data Serving and Visualization (not included in notebook)
 # MAGIC Now that our models are created and the data is scored, we can use Azure Synapse with PowerBI to perform data warehousing and analyltic reporting to generate a report like the one below. 
@@ -5,6 +5,9 @@
 # COMMAND ----------
 
 dbutils.widgets.text("BucketName",defaultValue = "",label="Enter Bucket Name")
+dbutils.widgets.text("ThumbnailSize",defaultValue = "64",label="Thumbnail Size (pixels)")
+dbutils.widgets.text("ThumbnailQuality",defaultValue = "75",label="Thumbnail JPEG Quality (1-95)")
+dbutils.widgets.dropdown("LoadMode",defaultValue = "full",choices = ["full","incremental","streaming"],label="Load Mode")
 
 # COMMAND ----------
 
@@ -14,6 +17,9 @@ dbutils.widgets.text("BucketName",defaultValue = "",label="Enter Bucket Name")
 # COMMAND ----------
 
 s3bucketname = dbutils.widgets.get("BucketName")
+thumbnail_size = int(dbutils.widgets.get("ThumbnailSize"))
+thumbnail_quality = int(dbutils.widgets.get("ThumbnailQuality"))
+load_mode = dbutils.widgets.get("LoadMode")
 
 # COMMAND ----------
 
@@ -70,32 +76,53 @@ spark.sql("USE main.external_loc")
 # MAGIC **User Defined Function (UDF) to resive image and convert to standard JPEG format**
 # MAGIC 
 # MAGIC **This is to make sure lesser data gets moved when rendering this data in Power BI and we don't get any Memory Errors**
+# MAGIC 
+# MAGIC **The UDF is a Pandas UDF, so images are sent to Python in Arrow batches instead of one row at a time. JPEG images are decoded in "draft" mode, which lets the decoder scale the image down (1/2, 1/4 or 1/8) while decoding instead of decoding at full resolution first**
 
 # COMMAND ----------
 
-# UDF to resize the image (change value for line 11 to apprropirate size based on your requirements)
+# Pandas UDF to resize the image (change the ThumbnailSize / ThumbnailQuality widgets based on your requirements)
 import io
-from pyspark.sql.functions import concat, base64, lit, col
+import pandas as pd
+from pyspark.sql.functions import col, pandas_udf
 from PIL import Image
 
-@udf("binary")
-def resized_image_binary(content):
-  
+# Images are large, so keep Arrow batches small enough to fit comfortably in executor memory
+spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", 256)
+
+def make_thumbnail(content, size, quality):
+  if content is None:
+    return None
   buffer = io.BytesIO()
   img = Image.open(io.BytesIO(content))
-  new_img = img.resize((64, 64))  # Choose your image size
-  new_img.save(buffer, format="JPEG")
-  img_binary = buffer.getvalue()
-  return img_binary
+  img.draft("RGB", size)                 # JPEG only: decode at the smallest DCT scale that is still >= size
+  new_img = img.convert("RGB").resize(size)
+  new_img.save(buffer, format="JPEG", quality=quality)
+  return buffer.getvalue()
+
+def resized_image_udf(size, quality):
+  @pandas_udf("binary")
+  def resized_image_binary(content: pd.Series) -> pd.Series:
+    return content.map(lambda c: make_thumbnail(c, size, quality))
+  return resized_image_binary
+
+resized_image_binary = resized_image_udf((thumbnail_size, thumbnail_size), thumbnail_quality)
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC **Prepare some Sample Data Sets which we will be saving as table later in this notebook**
+# MAGIC 
+# MAGIC **Both the sample data and the image files get a "file_key" column (the file name), which is used as a plain equality join key**
 
 # COMMAND ----------
 
 from pyspark.sql.types import StructType, StructField, StringType, IntegerType
+from pyspark.sql.functions import regexp_extract
+
+# Join key for an image: the last part of its path, after the final "/" or "-"
+def file_key(path_col):
+  return regexp_extract(path_col, r"([^/\-]+)$", 1)
 
 schema = StructType([
     StructField("id", IntegerType(),True), 
@@ -109,7 +136,7 @@ data = [(1,"Faux Pink Tulip",f"s3://{s3bucketname}/images/Faux_Pink_Tulips.jpeg"
       (4,"Wild Frangipani",f"s3://{s3bucketname}/images/Wild_Frangipani.jpg")
      ]
 
-df = spark.createDataFrame(data=data,schema=schema)
+df = spark.createDataFrame(data=data,schema=schema).withColumn("file_key", file_key(col("Location")))
 df.printSchema()
 display(df)
 
@@ -119,33 +146,61 @@ display(df)
 # MAGIC **Each image file has some propoerties like: Path, Content**
 # MAGIC 
 # MAGIC **We will be calling *"resized_image_binary" UDF on Content column* to convert file to JPEG and of a specific size**
+# MAGIC 
+# MAGIC **Only the thumbnail is kept. The original image stays in S3 and is referenced by "path", and the base64 preview is produced on read by the "Flower_Images_Preview" view created later in this notebook**
+# MAGIC 
+# MAGIC **In "incremental" Load Mode, only images that are new or changed since the last run (by path, modificationTime and length) are read and resized. The file listing below does not read the image content, as the "content" column is not selected**
+# MAGIC 
+# MAGIC **In "streaming" Load Mode, new images are picked up by Autoloader (cloudFiles with binaryFile format) as they land. Each micro-batch is capped by cloudFiles.maxBytesPerTrigger so large images cannot exhaust executor memory**
 
 # COMMAND ----------
 
-flowers_df = spark.read.format("binaryFile").load(f"s3://{s3bucketname}/images") \
-  .select(
-    col("path"),
-    col("content"),
-    resized_image_binary(col("content")).cast("binary").alias("resized_binary")
-  ) \
-  .withColumn("resized_image_base64",
-            concat(lit('data:image/jpeg;base64,'), base64(col("resized_binary"))))
-
-
-display(flowers_df)
+images_path = f"s3://{s3bucketname}/images"
+incremental = load_mode == "incremental" and spark.catalog.tableExists("Flower_Images")
+
+def with_thumbnails(images_df):
+  return images_df \
+    .select(
+      col("path"),
+      file_key(col("path")).alias("file_key"),
+      col("modificationTime"),
+      col("length"),
+      resized_image_binary(col("content")).cast("binary").alias("resized_binary")
+    )
+
+if load_mode == "streaming":
+  images_df = spark.readStream.format("cloudFiles") \
+    .option("cloudFiles.format", "binaryFile") \
+    .option("cloudFiles.maxBytesPerTrigger", "1g") \
+    .option("cloudFiles.maxFilesPerTrigger", 1000) \
+    .load(images_path)
+elif incremental:
+  image_keys = ["path","modificationTime","length"]
+  image_files = spark.read.format("binaryFile").load(images_path).select(image_keys)
+  source_paths = [r.path for r in image_files.join(spark.table("Flower_Images").select(image_keys), image_keys, "left_anti").collect()]
+  if not source_paths:
+    dbutils.notebook.exit("No new or changed images")
+  images_df = spark.read.format("binaryFile").load(source_paths)
+else:
+  images_df = spark.read.format("binaryFile").load(images_path)
+
+flowers_df = with_thumbnails(images_df)
+
+if not flowers_df.isStreaming:
+  display(flowers_df)
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC **Next, we will join both original data source dataframe and image file dataframe to form a single record to be saved in the delta table**
+# MAGIC 
+# MAGIC **The sample data is small, so it is broadcast and joined to every image on "file_key". The image side is never shuffled, and the same join works for batch and streaming loads**
 
 # COMMAND ----------
 
 import pyspark.sql.functions as F
 
-final_df = df.join(flowers_df, F.element_at(F.split("Location","\-"),-1) == F.element_at(F.split("path","\-"),-1),'left')
-
-
+final_df = flowers_df.join(F.broadcast(df), "file_key", "left")
 
 # COMMAND ----------
 
@@ -155,20 +210,76 @@ final_df = df.join(flowers_df, F.element_at(F.split("Location","\-"),-1) == F.el
 # COMMAND ----------
 
 #spark.sql("DROP TABLE Flower_Images")
-dbutils.fs.rm(f"s3://{s3bucketname}/flowerimages/",recurse=True)
+if load_mode == "full":
+  dbutils.fs.rm(f"s3://{s3bucketname}/flowerimages/",recurse=True)
 
 # COMMAND ----------
 
 # MAGIC %md
 # MAGIC **Save final dataframe as DELTA TABLE**
+# MAGIC 
+# MAGIC **In "incremental" Load Mode, new and changed images are MERGED into the table instead of overwriting it**
+# MAGIC 
+# MAGIC **In "streaming" Load Mode, every micro-batch is MERGED the same way, so a restarted or replayed batch does not create duplicate rows. The table is created empty before the stream starts, so the cells below work on a first run too**
 
 # COMMAND ----------
 
-final_df.write.option("path", f"s3://{s3bucketname}/flowerimages").mode("overwrite").saveAsTable("Flower_Images")
+def merge_flower_images(changes_df, batch_id=None):
+  changes_df = changes_df.where(col("path").isNotNull())
+  if not changes_df.sparkSession.catalog.tableExists("Flower_Images"):
+    changes_df.write.option("path", f"s3://{s3bucketname}/flowerimages").saveAsTable("Flower_Images")
+    return
+  changes_df.createOrReplaceTempView("flower_images_changes")
+  changes_df.sparkSession.sql("""
+    MERGE INTO Flower_Images t
+    USING flower_images_changes s
+    ON t.path = s.path
+    WHEN MATCHED THEN UPDATE SET *
+    WHEN NOT MATCHED THEN INSERT *
+  """)
+
+if load_mode == "streaming":
+  # Create the (empty) table with the final schema up front, so it can be queried before the first micro-batch is merged
+  if not spark.catalog.tableExists("Flower_Images"):
+    spark.createDataFrame([], final_df.schema).write.option("path", f"s3://{s3bucketname}/flowerimages").saveAsTable("Flower_Images")
+  image_stream = final_df.writeStream \
+    .foreachBatch(merge_flower_images) \
+    .option("checkpointLocation", f"s3://{s3bucketname}/flowerimages_checkpoint/") \
+    .trigger(processingTime="1 minute") \
+    .start()
+elif incremental:
+  merge_flower_images(final_df)
+else:
+  final_df.write.option("path", f"s3://{s3bucketname}/flowerimages").option("overwriteSchema", "true").mode("overwrite").saveAsTable("Flower_Images")
 display(spark.table("Flower_Images"))
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC **Create a view that renders the thumbnail as a base64 data URI on read. Point Power BI at this view: each row carries only the thumbnail (a few KB) instead of the original image bytes**
+
+# COMMAND ----------
+
+spark.sql("""
+  CREATE OR REPLACE VIEW Flower_Images_Preview AS
+  SELECT * EXCEPT (resized_binary),
+    concat('data:image/jpeg;base64,', base64(resized_binary)) AS resized_image_base64
+  FROM Flower_Images
+""")
+display(spark.table("Flower_Images_Preview"))
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC **Cluster the table by "file_key" (Z-ORDER), so looking up a single image only reads the file(s) that can contain it. In "streaming" Load Mode, schedule this OPTIMIZE separately instead of running it while the stream writes**
+
+# COMMAND ----------
+
+if load_mode != "streaming":
+  spark.sql("OPTIMIZE Flower_Images ZORDER BY (file_key)")
+
+# COMMAND ----------
+
 display(spark.sql("SHOW GRANT ON CATALOG main"))
 
 # COMMAND ----------